@@ -4,29 +4,119 @@ import boto3
 import botocore
 import os
 import shutil
+import tempfile
+import traceback
+import time
+import random
 import glob
 import zipfile
-from pathlib import Path
+import io
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
-s3 = boto3.client('s3')
+uploadConcurrency = int(os.environ.get('uploadConcurrency', '16'))
+transferConfig = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=int(os.environ.get('uploadPartConcurrency', '4')),
+)
 
+# Each upload thread may open several connections for multipart parts.
+s3 = boto3.client('s3', config=Config(
+    max_pool_connections=uploadConcurrency * transferConfig.max_concurrency))
 
-def clean_tmp():
-    folder = '/tmp/'
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
+rangeBlockSize = int(os.environ.get('rangeBlockSize', str(1024 * 1024)))
+rangeCacheBlocks = int(os.environ.get('rangeCacheBlocks', '16'))
+
+# Extracted images below these limits are dropped, larger ones are downscaled
+# to a resolution Rekognition still reads text from.
+imageMinDimension = int(os.environ.get('imageMinDimension', '50'))
+imageMinBytes = int(os.environ.get('imageMinBytes', '2048'))
+imageMinDensity = float(os.environ.get('imageMinDensity', '0'))
+imageMaxDimension = int(os.environ.get('imageMaxDimension', '1920'))
+imageMaxBytes = int(os.environ.get('imageMaxBytes', str(5 * 1024 * 1024)))
+
+recordConcurrency = int(os.environ.get('recordConcurrency', '4'))
+
+workspaceRoot = '/tmp/workspaces'
+workspaceQuota = int(os.environ.get('workspaceQuotaMb', '0')) * 1024 * 1024
+
+# In manifest mode extracted media go to the artifact bucket, which has no
+# per-object triggers, and each document gets one manifest listing them.
+moderationMode = os.environ.get('moderationMode', 'object')
+mediaBucket = os.environ.get('artifactBucket') if moderationMode == 'manifest' else None
+manifestName = 'artifacts.manifest'
+
+metricNamespace = os.environ.get('metricNamespace', 'AwsAiContentLibrary')
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+class Workspace:
+    # Private scratch directory for one record under workspaceRoot, removed
+    # when the context exits. Usage is checked against a quota so that
+    # concurrent records cannot exhaust the function's ephemeral storage.
+    # Without workspaceQuotaMb the disk is shared between the records that
+    # actually run at the same time, so a single record gets all of it.
+    def __init__(self, name='record', quota=None, concurrent=1):
+        os.makedirs(workspaceRoot, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=name + '-', dir=workspaceRoot)
+        self.quota = quota or workspaceQuota or (
+            shutil.disk_usage(workspaceRoot).total // max(concurrent, 1))
+
+    def __fspath__(self):
+        return self.path
+
+    def __str__(self):
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def usage(self):
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def reserve(self, size):
+        usage = self.usage()
+        if usage + size > self.quota:
+            raise WorkspaceQuotaExceeded('Workspace %s needs %d bytes but only %d of %d are free' % (
+                self.path, size, self.quota - usage, self.quota))
+
+
+def clean_workspaces():
+    # Only one invocation runs per container at a time, so anything left in
+    # workspaceRoot belongs to an earlier invocation that did not clean up.
+    if os.path.isdir(workspaceRoot):
+        for filename in os.listdir(workspaceRoot):
+            file_path = os.path.join(workspaceRoot, filename)
+            try:
                 shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-def save_file(bucket, key):
+def save_file(bucket, key, folder):
     try:
-        word_file_path = os.path.join("/tmp/", key)
+        word_file_path = os.path.join(folder, key)
+        if isinstance(folder, Workspace):
+            folder.reserve(s3.head_object(
+                Bucket=bucket, Key=key)['ContentLength'])
         os.makedirs(os.path.dirname(word_file_path), exist_ok=True)
         s3.download_file(Bucket=bucket, Key=key, Filename=word_file_path)
         return word_file_path
@@ -37,28 +127,312 @@ def save_file(bucket, key):
             raise
 
 
-def extract_media(file_path, prefix):
-    archive = zipfile.ZipFile(file_path)
-    for file in archive.filelist:
-        if file.filename.startswith(prefix):
-            filename, file_extension = os.path.splitext(file_path)
-            file_extension = file_extension[1:]
-            extract_media_file_dir = os.path.join(filename, file_extension)
-            os.makedirs(os.path.dirname(extract_media_file_dir), exist_ok=True)
-            archive.extract(file, path=extract_media_file_dir)
+class S3RangeFile(io.RawIOBase):
+    # Seekable read-only view of an S3 object backed by ranged GETs and a
+    # small LRU block cache, so zipfile only transfers the central directory
+    # and the members it actually reads.
+    def __init__(self, bucket, key, blockSize=rangeBlockSize, cacheBlocks=rangeCacheBlocks, s3_client=None):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.blockSize = blockSize
+        self.cacheBlocks = cacheBlocks
+        self.client = s3_client or s3
+        self.size = self.client.head_object(
+            Bucket=bucket, Key=key)['ContentLength']
+        self.position = 0
+        self.blocks = OrderedDict()
+        self.requests = 0
+        self.bytesFetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError("invalid whence (%r)" % whence)
+        if self.position < 0:
+            raise ValueError("negative seek position %d" % self.position)
+        return self.position
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.position)
+        if n <= 0:
+            return 0
+        b[:n] = self.read_range(self.position, n)
+        self.position += n
+        return n
+
+    def fetch(self, first, last):
+        start = first * self.blockSize
+        end = min((last + 1) * self.blockSize, self.size) - 1
+        response = self.client.get_object(
+            Bucket=self.bucket, Key=self.key, Range='bytes=%d-%d' % (start, end))
+        data = response['Body'].read()
+        self.requests += 1
+        self.bytesFetched += len(data)
+        return {i: data[(i - first) * self.blockSize:(i - first + 1) * self.blockSize]
+                for i in range(first, last + 1)}
+
+    def read_range(self, start, length):
+        first = start // self.blockSize
+        last = (start + length - 1) // self.blockSize
+        blocks = {}
+        run = []
+        for i in range(first, last + 1):
+            if i in self.blocks:
+                self.blocks.move_to_end(i)
+                blocks[i] = self.blocks[i]
+                if run:
+                    blocks.update(self.fetch(run[0], run[-1]))
+                    run = []
+            else:
+                run.append(i)
+        if run:
+            blocks.update(self.fetch(run[0], run[-1]))
+        for i in range(first, last + 1):
+            self.blocks[i] = blocks[i]
+            self.blocks.move_to_end(i)
+        while len(self.blocks) > self.cacheBlocks:
+            self.blocks.popitem(last=False)
+        data = b"".join(blocks[i] for i in range(first, last + 1))
+        offset = start - first * self.blockSize
+        return data[offset:offset + length]
+
+    def close(self):
+        if not self.closed:
+            print('Read %s/%s with %d ranged requests, %d of %d bytes' % (
+                self.bucket, self.key, self.requests, self.bytesFetched, self.size))
+        super().close()
+
+
+def get_artifact_prefix(key, ext=None):
+    filename, file_extension = os.path.splitext(key)
+    return filename + "/" + (ext or file_extension[1:]) + "/"
+
+
+class ImageFilter:
+    # Drops images too small to moderate and downscales oversized ones before
+    # upload. Every image uploaded costs a DetectText and a
+    # DetectModerationLabels call in the image moderator.
+    def __init__(self, minDimension=imageMinDimension, minBytes=imageMinBytes,
+                 minDensity=imageMinDensity, maxDimension=imageMaxDimension,
+                 maxBytes=imageMaxBytes):
+        self.minDimension = minDimension
+        self.minBytes = minBytes
+        self.minDensity = minDensity
+        self.maxDimension = maxDimension
+        self.maxBytes = maxBytes
+        self.counters = {'imagesKept': 0, 'imagesDropped': 0, 'imagesDownscaled': 0,
+                         'imageBytesSaved': 0, 'rekognitionCallsSaved': 0}
+
+    def drop(self, data):
+        self.counters['imagesDropped'] += 1
+        self.counters['imageBytesSaved'] += len(data)
+        self.counters['rekognitionCallsSaved'] += 2
+        return None
+
+    def downscale(self, image, data, name):
+        from PIL import Image
+        image.thumbnail((self.maxDimension, self.maxDimension), Image.LANCZOS)
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image.save(output, format='PNG', optimize=True)
+            ext = 'png'
+        else:
+            image.convert('RGB').save(output, format='JPEG', quality=85)
+            ext = 'jpg'
+        if output.tell() >= len(data):
+            return data, name
+        self.counters['imagesDownscaled'] += 1
+        self.counters['imageBytesSaved'] += len(data) - output.tell()
+        return output.getvalue(), os.path.splitext(name)[0] + '.' + ext
+
+    def apply(self, data, name, width=None, height=None, colorspace=None):
+        # Returns the (data, name) to upload, or None if the image is dropped.
+        if len(data) < self.minBytes:
+            return self.drop(data)
+        image = None
+        if width is None or height is None:
+            try:
+                from PIL import Image
+                image = Image.open(io.BytesIO(data))
+                width, height = image.size
+            except Exception as e:
+                # Formats Pillow cannot read (EMF, WMF, ...) pass unchanged.
+                print('Cannot read image %s: %s' % (name, e))
+                self.counters['imagesKept'] += 1
+                return data, name
+        if min(width, height) < self.minDimension:
+            return self.drop(data)
+        if self.minDensity and colorspace and len(data) / (width * height * colorspace) <= self.minDensity:
+            return self.drop(data)
+        if max(width, height) > self.maxDimension or len(data) > self.maxBytes:
+            try:
+                if image is None:
+                    from PIL import Image
+                    image = Image.open(io.BytesIO(data))
+                data, name = self.downscale(image, data, name)
+            except Exception as e:
+                print('Cannot downscale image %s: %s' % (name, e))
+        self.counters['imagesKept'] += 1
+        return data, name
+
+    def merge(self, stats):
+        for name, value in stats.items():
+            self.counters[name] += value
+
+    def stats(self):
+        return dict(self.counters)
+
+
+def upload_member(archive, member, outputPrefix, uploader, imageFilter=None):
+    data, name = archive.read(member), member.filename
+    if imageFilter is not None:
+        filtered = imageFilter.apply(data, name)
+        if filtered is None:
+            return
+        data, name = filtered
+    uploader.put_bytes(outputPrefix + name, data, mediaBucket)
+
+
+def upload_media(file, prefix, key, uploader, imageFilter=None):
+    outputPrefix = get_artifact_prefix(key)
+    with zipfile.ZipFile(file) as archive:
+        for file in archive.infolist():
+            if file.filename.startswith(prefix) and not file.is_dir():
+                upload_member(archive, file, outputPrefix, uploader, imageFilter)
+
+
+def upload_file(path, bucket, key, s3_client=None):
+    start = time.time()
+    result = {'file': str(path), 'bucket': bucket, 'key': key,
+              'size': os.path.getsize(path)}
+    try:
+        (s3_client or s3).upload_file(
+            Filename=str(path), Bucket=bucket, Key=key, Config=transferConfig)
+        result['status'] = 'OK'
+    except Exception as e:
+        result['status'] = 'FAILED'
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def upload_bytes(data, bucket, key, s3_client=None):
+    start = time.time()
+    result = {'file': None, 'bucket': bucket, 'key': key, 'size': len(data)}
+    try:
+        (s3_client or s3).upload_fileobj(
+            io.BytesIO(data), Bucket=bucket, Key=key, Config=transferConfig)
+        result['status'] = 'OK'
+    except Exception as e:
+        result['status'] = 'FAILED'
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    return result
 
 
-def copy_tmp_to_processing_bucket():
-    print('copy_tmp_to_processing_bucket')
-    processingBucket = os.environ['processingBucket']
-    for path in Path("/tmp/").rglob('*.*'):
-        print(path)
-        if os.path.isfile(path):
-            s3.upload_file(
-                Filename=str(path),
-                Bucket=processingBucket,
-                Key=str(path)[len("/tmp/"):],
-            )
+def report_uploads(manifest, seconds):
+    seconds = max(seconds, 1e-6)
+    uploaded = [r for r in manifest if r['status'] == 'OK']
+    totalBytes = sum(r['size'] for r in uploaded)
+    print('Uploaded %d of %d files, %d bytes in %.2fs (%.2f MB/s)' % (
+        len(uploaded), len(manifest), totalBytes, seconds, totalBytes / seconds / 1048576))
+    emit_metrics({'uploadedFiles': len(uploaded),
+                  'failedUploads': len(manifest) - len(uploaded)})
+    emit_metrics({'uploadThroughput': totalBytes / seconds}, unit='Bytes/Second')
+
+
+def check_uploads(manifest):
+    failed = [r for r in manifest if r['status'] != 'OK']
+    for r in failed:
+        print('Failed to upload %s. Reason: %s' % (r['key'], r['error']))
+    if failed:
+        raise Exception('%d of %d uploads failed' % (len(failed), len(manifest)))
+    return manifest
+
+
+def write_manifest(key, uploads):
+    if mediaBucket is None:
+        return None
+    manifestKey = get_artifact_prefix(key) + manifestName
+    manifest = {
+        'source': key,
+        'artifacts': [{'bucket': r['bucket'], 'key': r['key'], 'size': r['size']}
+                      for r in uploads if r['status'] == 'OK'],
+    }
+    check_uploads([upload_bytes(json.dumps(manifest).encode('utf-8'),
+                                mediaBucket, manifestKey)])
+    print('Wrote manifest %s with %d artifacts' % (manifestKey, len(manifest['artifacts'])))
+    return manifestKey
+
+
+class ArtifactUploader:
+    # Uploads artifacts on background threads as soon as they are produced.
+    # put_bytes blocks once maxPending artifacts are waiting, which bounds
+    # the memory held by in-flight buffers.
+    def __init__(self, bucket=None, max_workers=uploadConcurrency, maxPending=None, s3_client=None):
+        self.bucket = bucket or os.environ['processingBucket']
+        self.s3_client = s3_client
+        self.queue = queue.Queue(maxsize=maxPending or max_workers * 2)
+        self.manifest = []
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.threads = [threading.Thread(target=self.run, daemon=True)
+                        for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put_bytes(self, key, data, bucket=None):
+        self.queue.put((data, None, bucket or self.bucket, key))
+
+    def put_file(self, path, key, bucket=None, delete=True):
+        self.queue.put((None, (str(path), delete), bucket or self.bucket, key))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, file, bucket, key = item
+            if file is None:
+                result = upload_bytes(data, bucket, key, self.s3_client)
+            else:
+                path, delete = file
+                result = upload_file(path, bucket, key, self.s3_client)
+                if delete and result['status'] == 'OK':
+                    os.remove(path)
+            with self.lock:
+                self.manifest.append(result)
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        report_uploads(self.manifest, time.time() - self.start)
+        return self.manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        manifest = self.close()
+        if exc_type is None:
+            check_uploads(manifest)
 
 
 def get_source_file_and_moderate_content(filePathName):
@@ -94,3 +468,215 @@ def get_video_convert_key(key):
         return filePathName
     else:
         return key + "/subType/" + filePathName
+
+
+def emit_metrics(metrics, unit='Count', dimensions=None):
+    # CloudWatch Embedded Metric Format, picked up from the function log.
+    dimensions = dimensions or {
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metricNamespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in metrics],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(metrics)
+    print(json.dumps(record))
+
+
+throttleErrorCodes = ('Throttling', 'ThrottlingException', 'ThrottledException',
+                      'TooManyRequestsException', 'RequestLimitExceeded',
+                      'ProvisionedThroughputExceededException', 'LimitExceededException')
+
+
+def get_error_kind(e):
+    # Returns 'throttle' or 'transient' for errors worth retrying, else None.
+    # Connection failures and read timeouts are the errors botocore's own
+    # retries covered before limited_client turned them off.
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return 'transient'
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return None
+    code = e.response.get('Error', {}).get('Code')
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    if code in throttleErrorCodes or status == 429:
+        return 'throttle'
+    if status >= 500:
+        return 'transient'
+    return None
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit for one AWS service: each success raises the limit
+    # by 1/limit (about +1 per round of calls), each throttle halves it and
+    # other failures leave it alone. Throttled, 5xx and connection failures
+    # are retried with full jitter backoff.
+    def __init__(self, name, initial=4, minimum=1, maximum=32,
+                 maxAttempts=6, backoffBase=0.2, backoffCap=10):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.active = 0
+        self.condition = threading.Condition()
+        self.counters = {'Calls': 0, 'Throttles': 0, 'Retries': 0}
+        self.queueWaits = []
+
+    def acquire(self):
+        start = time.time()
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+            self.queueWaits.append((time.time() - start) * 1000)
+
+    def release(self, outcome):
+        # outcome is 'success', 'throttle', 'transient' or 'error'.
+        with self.condition:
+            self.active -= 1
+            self.counters['Calls'] += 1
+            if outcome == 'throttle':
+                self.counters['Throttles'] += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            elif outcome == 'success':
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.maxAttempts):
+            self.acquire()
+            outcome = 'error'
+            try:
+                result = fn(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except Exception as e:
+                outcome = get_error_kind(e) or 'error'
+                if outcome == 'error' or attempt == self.maxAttempts - 1:
+                    raise
+            finally:
+                self.release(outcome)
+            with self.condition:
+                self.counters['Retries'] += 1
+            time.sleep(random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt)))
+
+    def stats(self, reset=False):
+        with self.condition:
+            counts = {self.name + name: value for name, value in self.counters.items()}
+            waits = self.queueWaits
+            limit = self.limit
+            if reset:
+                self.counters = dict.fromkeys(self.counters, 0)
+                self.queueWaits = []
+        # The limit is a number of calls, so it goes out with the counts.
+        counts[self.name + 'ConcurrencyLimit'] = limit
+        timings = {}
+        if waits:
+            timings[self.name + 'QueueWaitAvg'] = sum(waits) / len(waits)
+            timings[self.name + 'QueueWaitMax'] = max(waits)
+        return counts, timings
+
+
+class LimitedClient:
+    # Routes the API calls of a boto3 client through an AdaptiveLimiter.
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in ('get_paginator', 'get_waiter', 'can_paginate'):
+            return attr
+        return lambda *args, **kwargs: self.limiter.call(attr, *args, **kwargs)
+
+
+limiters = {}
+limitersLock = threading.Lock()
+
+
+def get_limiter(name):
+    # One limiter per service and execution environment, sized by
+    # <name>Concurrency and <name>MaxConcurrency.
+    with limitersLock:
+        if name not in limiters:
+            limiters[name] = AdaptiveLimiter(
+                name,
+                initial=int(os.environ.get(name + 'Concurrency', '4')),
+                maximum=int(os.environ.get(name + 'MaxConcurrency', '32')))
+        return limiters[name]
+
+
+def limited_client(service, name=None, **kwargs):
+    # botocore retries are turned off so the limiter sees every throttle.
+    config = Config(retries={'mode': 'standard', 'max_attempts': 1})
+    return LimitedClient(boto3.client(service, config=config, **kwargs),
+                         get_limiter(name or service))
+
+
+def emit_limiter_metrics():
+    for limiter in list(limiters.values()):
+        counts, timings = limiter.stats(reset=True)
+        emit_metrics(counts)
+        if timings:
+            emit_metrics(timings, unit='Milliseconds')
+
+
+def get_s3_object(record):
+    bucket = record['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(
+        record['s3']['object']['key'], encoding='utf-8')
+    return bucket, key
+
+
+def get_records(event):
+    # Yields (itemIdentifier, record) pairs. S3 notifications delivered
+    # through SQS are unwrapped so handlers always see the S3 record.
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            for inner in body.get('Records', []):
+                yield record['messageId'], inner
+        else:
+            yield None, record
+
+
+def get_failure(itemIdentifier, record, e):
+    print('Failed to process record %s. Reason: %s' % (
+        itemIdentifier or json.dumps(record)[:1024], e))
+    return itemIdentifier or e
+
+
+def process_records(event, handle_record, max_workers=recordConcurrency):
+    clean_workspaces()
+    records = list(get_records(event))
+    isQueue = any(itemIdentifier is not None for itemIdentifier, _ in records)
+
+    def run(item):
+        itemIdentifier, record = item
+        try:
+            with Workspace(concurrent=workers) as workspace:
+                handle_record(record, workspace)
+            return None
+        except Exception as e:
+            traceback.print_exc()
+            return get_failure(itemIdentifier, record, e)
+
+    workers = max(1, min(max_workers, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        failures = [f for f in executor.map(run, records) if f is not None]
+    emit_metrics({'processedRecords': len(records),
+                  'failedRecords': len(failures)})
+    if failures and not isQueue:
+        # Only queue triggers support partial batch responses, so fail the
+        # whole invocation and let Lambda retry it.
+        raise Exception('%d of %d records failed: %s' % (
+            len(failures), len(records), failures[0]))
+    return {'batchItemFailures': [{'itemIdentifier': i} for i in dict.fromkeys(failures)]}
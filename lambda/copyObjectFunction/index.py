@@ -7,12 +7,14 @@ print('Loading function')
 s3 = boto3.client('s3')
 
 
-def lambda_handler(event, context):
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+def copy_object(record, workspace):
+    bucket, key = get_s3_object(record)
     contentLibraryBucket = bucket
     processingBucket = os.environ['processingBucket']
 
     return s3.copy_object(Bucket=processingBucket,
                           CopySource={'Bucket': contentLibraryBucket, 'Key': key}, Key=key)
+
+
+def lambda_handler(event, context):
+    return process_records(event, copy_object)
@@ -0,0 +1,169 @@
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+
+import boto3
+from PIL import Image
+
+# The 64-bit dHash is split into 4 bands of 16 bits. Two hashes within a
+# Hamming distance of 3 always share at least one band exactly, so looking up
+# every band finds all near duplicates up to that distance.
+bandCount = 4
+bandBits = 64 // bandCount
+maxDistance = min(int(os.environ.get('imageHashDistance', '3')), bandCount - 1)
+# Images with the same layout but different wording can hash as near
+# duplicates, so reusing their labels is opt-in and their text never is.
+reuseNearDuplicates = os.environ.get('imageNearDuplicateReuse', 'false') == 'true'
+
+
+def get_content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_dhash(data):
+    try:
+        image = Image.open(io.BytesIO(data))
+        gray = image.convert('L').resize((9, 8), Image.LANCZOS)
+    except Exception as e:
+        print('Cannot compute perceptual hash: %s' % e)
+        return None
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def get_bands(dhash):
+    mask = (1 << bandBits) - 1
+    return [(dhash >> (i * bandBits)) & mask for i in range(bandCount)]
+
+
+class ImageIndex:
+    # Persistent index of Rekognition results keyed by content hash, with
+    # dHash band entries pointing at the content hashes for near duplicates.
+    # The index only saves work, so its errors are logged and counted and
+    # lookups fall back to a miss.
+    def __init__(self, tableName, ttl=7776000, client=None,
+                 maxAttempts=6, backoffBase=0.05, backoffCap=2):
+        self.tableName = tableName
+        self.ttl = ttl
+        self.client = client or boto3.client('dynamodb')
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.lock = threading.Lock()
+        self.counters = {'imageIndexExactHits': 0, 'imageIndexNearHits': 0,
+                         'imageIndexMisses': 0, 'imageIndexErrors': 0}
+
+    def backoff(self, attempt):
+        if attempt + 1 >= self.maxAttempts:
+            return False
+        time.sleep(random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt)))
+        return True
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_result(self, contentHash):
+        response = self.client.get_item(TableName=self.tableName, Key={
+            'hashKey': {'S': 'sha256#' + contentHash},
+            'sortKey': {'S': 'result'},
+        })
+        item = response.get('Item')
+        if item is None or int(item['expiresAt']['N']) <= time.time():
+            return None
+        return json.loads(item['result']['S'])
+
+    def find_near_duplicate(self, dhash):
+        candidates = set()
+        for i, band in enumerate(get_bands(dhash)):
+            query = {
+                'TableName': self.tableName,
+                'KeyConditionExpression': 'hashKey = :h',
+                'ExpressionAttributeValues': {
+                    ':h': {'S': 'dhash#%d#%04x' % (i, band)}},
+            }
+            while True:
+                response = self.client.query(**query)
+                for item in response['Items']:
+                    candidateHash, contentHash = item['sortKey']['S'].split('#')
+                    distance = bin(int(candidateHash, 16) ^ dhash).count('1')
+                    if distance <= maxDistance:
+                        candidates.add((distance, contentHash))
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        for distance, contentHash in sorted(candidates):
+            result = self.get_result(contentHash)
+            if result is not None:
+                return result
+        return None
+
+    def lookup(self, contentHash, dhash=None):
+        # Returns (result, exact). Only an exact hit may be reused as a whole.
+        try:
+            result = self.get_result(contentHash)
+            if result is not None:
+                self.count('imageIndexExactHits')
+                return result, True
+            if dhash is not None and reuseNearDuplicates:
+                result = self.find_near_duplicate(dhash)
+                if result is not None:
+                    self.count('imageIndexNearHits')
+                    return result, False
+        except Exception as e:
+            print('Image index lookup failed: %s' % e)
+            self.count('imageIndexErrors')
+            return None, False
+        self.count('imageIndexMisses')
+        return None, False
+
+    def store(self, contentHash, dhash, result):
+        try:
+            self.write(contentHash, dhash, result)
+        except Exception as e:
+            print('Image index store failed: %s' % e)
+            self.count('imageIndexErrors')
+
+    def write(self, contentHash, dhash, result):
+        expiresAt = {'N': str(int(time.time()) + self.ttl)}
+        requests = [{'PutRequest': {'Item': {
+            'hashKey': {'S': 'sha256#' + contentHash},
+            'sortKey': {'S': 'result'},
+            'result': {'S': json.dumps(result)},
+            'expiresAt': expiresAt,
+        }}}]
+        # Band entries are only read for near-duplicate reuse.
+        if dhash is not None and reuseNearDuplicates:
+            for i, band in enumerate(get_bands(dhash)):
+                requests.append({'PutRequest': {'Item': {
+                    'hashKey': {'S': 'dhash#%d#%04x' % (i, band)},
+                    'sortKey': {'S': '%016x#%s' % (dhash, contentHash)},
+                    'expiresAt': expiresAt,
+                }}})
+        request = {self.tableName: requests}
+        attempt = 0
+        while request:
+            response = self.client.batch_write_item(RequestItems=request)
+            request = response.get('UnprocessedItems')
+            if request and not self.backoff(attempt):
+                print('Dropped %d image index writes' % len(request[self.tableName]))
+                break
+            attempt += 1
+
+    def stats(self, reset=False):
+        with self.lock:
+            stats = dict(self.counters)
+            if reset:
+                for name in self.counters:
+                    self.counters[name] = 0
+        return stats
@@ -2,24 +2,57 @@ import urllib.parse
 import os
 from common import *
 import boto3
+from image_index import ImageIndex, get_content_hash, get_dhash, reuseNearDuplicates
+from mosaic import *
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import io
+import time
 
 print('Loading function')
-rekognition = boto3.client('rekognition')
+rekognition = limited_client('rekognition')
 s3 = boto3.client('s3')
 sns = boto3.client('sns')
 
 
-def extract_text(bucket, key, file_path):
-    response = rekognition.detect_text(
-        Image={'S3Object': {'Bucket': bucket, 'Name': key}})
+# Text and moderation label detection of a record run side by side.
+detectExecutor = ThreadPoolExecutor(max_workers=2 * recordConcurrency)
+
+manifestConcurrency = int(os.environ.get('manifestConcurrency', '8'))
+# Manifest images are not started once less than this much time is left.
+manifestTimeMargin = float(os.environ.get('manifestTimeMarginSeconds', '30'))
+invocationDeadline = None
+imageExtensions = ('.jpeg', '.jpg', '.png')
+
+imageIndex = None
+if os.environ.get('imageIndexTableName'):
+    imageIndex = ImageIndex(os.environ['imageIndexTableName'])
+
+
+def get_texts(textDetections):
     lines = []
     words = []
-    for text in response['TextDetections']:
+    for text in textDetections:
         if text['Type'] == 'LINE':
             lines.append(text['DetectedText'])
         elif text['Type'] == 'WORD':
             words.append(text['DetectedText'])
-    texts = lines + words
+    return lines + words
+
+
+def detect_text(bucket, key):
+    response = rekognition.detect_text(
+        Image={'S3Object': {'Bucket': bucket, 'Name': key}})
+    return get_texts(response['TextDetections'])
+
+
+def detect_moderation_labels(bucket, key):
+    response = rekognition.detect_moderation_labels(
+        Image={'S3Object': {'Bucket': bucket, 'Name': key}})
+    return response['ModerationLabels']
+
+
+def extract_text(key, texts):
     output_key = get_moderate_content_key(key, "txt")
     print("\n".join(texts))
     print(output_key)
@@ -28,16 +61,14 @@ def extract_text(bucket, key, file_path):
         Body=text, Bucket=os.environ['processingBucket'], Key=output_key)
 
 
-def moderate_image(bucket, key):
-    response = rekognition.detect_moderation_labels(
-        Image={'S3Object': {'Bucket': bucket, 'Name': key}})
-    if len(response['ModerationLabels']) > 0:
+def moderate_image(key, moderationLabels):
+    if len(moderationLabels) > 0:
         source, moderateContent = get_source_file_and_moderate_content(key)
         message = {
             'source': source,
             'moderateContent': moderateContent,
             'problem': 'Image',
-            'details': json.dumps(response['ModerationLabels'])
+            'details': json.dumps(moderationLabels)
         }
         response = sns.publish(
             TargetArn=os.environ['moderationTopic'],
@@ -46,19 +77,249 @@ def moderate_image(bucket, key):
         )
 
 
-def lambda_handler(event, context):
-    clean_tmp()
+def timed(timings, stage, fn, *args):
+    start = time.time()
+    try:
+        return fn(*args)
+    finally:
+        timings[stage] = (time.time() - start) * 1000
+
+
+def detect(bucket, key, timings=None):
+    # Both calls read the image straight from S3, so nothing is downloaded.
+    timings = {} if timings is None else timings
+    texts = detectExecutor.submit(
+        timed, timings, 'detectTextLatency', detect_text, bucket, key)
+    labels = detectExecutor.submit(
+        timed, timings, 'detectModerationLabelsLatency', detect_moderation_labels, bucket, key)
+    return {
+        'texts': texts.result(),
+        'moderationLabels': labels.result(),
+    }
+
+
+def detect_with_index(bucket, key, timings):
+    # Only the index needs the image bytes, and they are hashed in memory.
+    data = timed(timings, 'downloadLatency', lambda: s3.get_object(
+        Bucket=bucket, Key=key)['Body'].read())
+    contentHash = get_content_hash(data)
+    # The perceptual hash decodes the whole image, so it is only computed
+    # when near duplicates may be reused.
+    dhash = get_dhash(data) if reuseNearDuplicates else None
+    result, exact = timed(timings, 'indexLookupLatency',
+                          imageIndex.lookup, contentHash, dhash)
+    if exact:
+        print('Reusing Rekognition results for %s' % key)
+        return result
+    if result is not None:
+        # A near duplicate may carry different text, so only its moderation
+        # labels are reused and the result is not stored under this hash.
+        print('Reusing moderation labels of a near duplicate for %s' % key)
+        return {
+            'texts': timed(timings, 'detectTextLatency', detect_text, bucket, key),
+            'moderationLabels': result['moderationLabels'],
+        }
+    result = detect(bucket, key, timings)
+    imageIndex.store(contentHash, dhash, result)
+    return result
+
+
+def publish(key, result):
+    extract_text(key, result['texts'])
+    moderate_image(key, result['moderationLabels'])
+
+
+def load_tile(artifact):
+    # Returns the decoded image if it is small enough for a mosaic sheet,
+    # otherwise None to leave it to detect_artifact.
+    try:
+        data = s3.get_object(Bucket=artifact['bucket'], Key=artifact['key'])['Body'].read()
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        # Leave it to detect_artifact, which reports the failure.
+        print('Cannot load %s for mosaic: %s' % (artifact['key'], e))
+        return None
+    if not is_tile(image):
+        return None
+    return dict(artifact, data=data, image=image)
+
+
+def moderate_sheet(tiles):
+    data, boxes, size = build_sheet([tile['image'] for tile in tiles])
+    textDetections = rekognition.detect_text(
+        Image={'Bytes': data})['TextDetections']
+    moderationLabels = rekognition.detect_moderation_labels(
+        Image={'Bytes': data})['ModerationLabels']
+    if is_word_limit_reached(textDetections):
+        texts = [detect_text(tile['bucket'], tile['key']) for tile in tiles]
+    else:
+        texts = [get_texts(detections) for detections in
+                 split_text_detections(textDetections, boxes, size)]
+    if len(moderationLabels) > 0:
+        # Moderation labels carry no bounding boxes, so the tiles of a
+        # flagged sheet are checked again one by one.
+        labels = [detect_moderation_labels(tile['bucket'], tile['key'])
+                  for tile in tiles]
+    else:
+        labels = [[] for _ in tiles]
+    return [{'texts': t, 'moderationLabels': l} for t, l in zip(texts, labels)]
+
+
+def moderate_tiles(artifacts):
+    # Small images of a manifest share mosaic sheets, so up to
+    # mosaicColumns * mosaicColumns of them cost two Rekognition calls
+    # together. Returns one entry per artifact: a result, an exception, or
+    # None for images that are not tiles.
+    results = [None] * len(artifacts)
+    with ThreadPoolExecutor(max_workers=manifestConcurrency) as executor:
+        loaded = list(executor.map(load_tile, artifacts))
+    tiles = []
+    for i, tile in enumerate(loaded):
+        if tile is None:
+            continue
+        tile['index'] = i
+        if imageIndex is not None:
+            tile['contentHash'] = get_content_hash(tile['data'])
+            tile['dhash'] = get_dhash(tile['data']) if reuseNearDuplicates else None
+            # Near duplicates still go on a sheet, which reads their text.
+            result, exact = imageIndex.lookup(tile['contentHash'], tile['dhash'])
+            if exact:
+                results[i] = result
+                continue
+        tiles.append(tile)
+    sheets = get_sheets(tiles)
+    for sheet in sheets:
+        if invocationDeadline is not None and time.time() > invocationDeadline - manifestTimeMargin:
+            outputs = [TimeoutError('Not started before the invocation deadline')] * len(sheet)
+        else:
+            try:
+                if len(sheet) > 1:
+                    outputs = moderate_sheet(sheet)
+                else:
+                    outputs = [detect(sheet[0]['bucket'], sheet[0]['key'])]
+            except Exception as e:
+                print('Cannot moderate mosaic sheet: %s' % e)
+                outputs = [e] * len(sheet)
+        for tile, result in zip(sheet, outputs):
+            results[tile['index']] = result
+            if imageIndex is not None and not isinstance(result, Exception):
+                imageIndex.store(tile['contentHash'], tile['dhash'], result)
+    print('%d tiles moderated in %d mosaic sheets' % (len(tiles), len(sheets)))
+    emit_metrics({'mosaicTiles': len(tiles), 'mosaicSheets': len(sheets)})
+    return results
+
+
+def detect_artifact(artifact):
+    timings = {}
+    if imageIndex is None:
+        return detect(artifact['bucket'], artifact['key'], timings)
+    return detect_with_index(artifact['bucket'], artifact['key'], timings)
+
+
+def moderate_artifact(artifact):
+    # Returns the detection result, or the exception of an image that failed
+    # or was not started before the deadline.
+    if invocationDeadline is not None and time.time() > invocationDeadline - manifestTimeMargin:
+        return TimeoutError('Not started before the invocation deadline')
+    try:
+        return detect_artifact(artifact)
+    except Exception as e:
+        print('Cannot moderate %s: %s' % (artifact['key'], e))
+        return e
+
+
+def moderate_manifest(bucket, key):
+    # Moderates every image of a document in one invocation and publishes one
+    # aggregated verdict. The recognised text of all images goes to the text
+    # moderator as a single images_text.json keyed by image.
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    prefix = key[:-len(manifestName)]
+    images = [a for a in manifest['artifacts']
+              if a['key'].lower().endswith(imageExtensions)]
+    results = [None] * len(images)
+    small = [i for i, a in enumerate(images) if a['size'] <= mosaicMaxBytes]
+    # A single image gains nothing from a sheet, and detect_artifact never
+    # downloads it without the index.
+    if mosaicColumns > 1 and len(small) > 1:
+        for i, result in zip(small, moderate_tiles([images[i] for i in small])):
+            results[i] = result
+    rest = [i for i, result in enumerate(results) if result is None]
+    with ThreadPoolExecutor(max_workers=manifestConcurrency) as executor:
+        for i, result in zip(rest, executor.map(moderate_artifact, [images[i] for i in rest])):
+            results[i] = result
+    texts = {}
+    labels = {}
+    failed = {}
+    for artifact, result in zip(images, results):
+        name = artifact['key'][len(prefix):]
+        if isinstance(result, Exception):
+            failed[name] = result
+            continue
+        if result['texts']:
+            texts[name] = "\n".join(result['texts'])
+        if result['moderationLabels']:
+            labels[name] = result['moderationLabels']
+    emit_metrics({'manifestImages': len(images), 'flaggedImages': len(labels),
+                  'failedImages': len(failed)})
+    if texts:
+        s3.put_object(Body=json.dumps(texts), Bucket=os.environ['processingBucket'],
+                      Key=prefix + 'images_text.json')
+    if labels or failed:
+        source, moderateContent = get_source_file_and_moderate_content(key)
+        message = {
+            'source': source,
+            'moderateContent': moderateContent,
+            'problem': 'Image' if labels else 'ImageNotModerated',
+            'details': json.dumps(labels)
+        }
+        if failed:
+            # Partial result: these images have no verdict. Retrying the whole
+            # manifest would repeat every Rekognition call and the publish.
+            message['failedImages'] = json.dumps({name: str(e) for name, e in failed.items()})
+        sns.publish(
+            TargetArn=os.environ['moderationTopic'],
+            Message=json.dumps({'default': json.dumps(message)}),
+            MessageStructure='json'
+        )
+    print('%d of %d images flagged and %d failed in %s' % (len(labels), len(images), len(failed), key))
+    return 'OK'
+
+
+def moderate_record(record, workspace):
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    bucket, key = get_s3_object(record)
+    if key.endswith(manifestName):
+        return moderate_manifest(bucket, key)
+    timings = {}
+    start = time.time()
     try:
-        file_path = save_file(bucket, key)
-        extract_text(bucket, key, file_path)
-        moderate_image(bucket, key)
-        # copy_tmp_to_processing_bucket()
+        if imageIndex is None:
+            result = detect(bucket, key, timings)
+        else:
+            result = detect_with_index(bucket, key, timings)
+        timings['detectLatency'] = (time.time() - start) * 1000
+        timed(timings, 'publishLatency', publish, key, result)
+        timings['recordLatency'] = (time.time() - start) * 1000
+        emit_metrics(timings, unit='Milliseconds')
         return 'OK'
     except Exception as e:
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
+
+
+def lambda_handler(event, context):
+    global invocationDeadline
+    invocationDeadline = time.time() + context.get_remaining_time_in_millis() / 1000
+    try:
+        return process_records(event, moderate_record)
+    finally:
+        emit_limiter_metrics()
+        if imageIndex is not None:
+            stats = imageIndex.stats(reset=True)
+            emit_metrics(stats)
+            lookups = stats['imageIndexExactHits'] + stats['imageIndexNearHits'] + stats['imageIndexMisses']
+            if lookups > 0:
+                hits = stats['imageIndexExactHits'] + stats['imageIndexNearHits']
+                emit_metrics({'imageIndexHitRate': 100.0 * hits / lookups}, unit='Percent')
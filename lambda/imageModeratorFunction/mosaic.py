@@ -0,0 +1,81 @@
+import io
+import math
+import os
+
+from PIL import Image
+
+mosaicMaxTileSize = int(os.environ.get('mosaicMaxTileSize', '256'))
+mosaicMaxBytes = int(os.environ.get('mosaicMaxBytes', str(256 * 1024)))
+mosaicColumns = int(os.environ.get('mosaicColumns', '4'))
+mosaicCellSize = int(os.environ.get('mosaicCellSize', '320'))
+# White border around every tile, so text lines never run across two tiles.
+mosaicGutter = int(os.environ.get('mosaicGutter', '24'))
+# DetectText returns at most 100 words per image.
+maxWordsPerImage = 100
+
+
+def is_tile(image):
+    return max(image.size) <= mosaicMaxTileSize
+
+
+def get_sheets(tiles):
+    size = mosaicColumns * mosaicColumns
+    return [tiles[i:i + size] for i in range(0, len(tiles), size)]
+
+
+def build_sheet(images):
+    rows = math.ceil(len(images) / mosaicColumns)
+    columns = min(len(images), mosaicColumns)
+    sheet = Image.new('RGB', (columns * mosaicCellSize,
+                      rows * mosaicCellSize), 'white')
+    inner = mosaicCellSize - 2 * mosaicGutter
+    boxes = []
+    for i, image in enumerate(images):
+        column = i % mosaicColumns
+        row = i // mosaicColumns
+        width, height = image.size
+        scale = min(inner / width, inner / height)
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        tile = image.convert('RGB').resize(size)
+        left = column * mosaicCellSize + (mosaicCellSize - size[0]) // 2
+        top = row * mosaicCellSize + (mosaicCellSize - size[1]) // 2
+        sheet.paste(tile, (left, top))
+        boxes.append((left, top, size[0], size[1]))
+    output = io.BytesIO()
+    sheet.save(output, format='JPEG', quality=90)
+    return output.getvalue(), boxes, sheet.size
+
+
+def find_tile(boxes, x, y):
+    for i, (left, top, width, height) in enumerate(boxes):
+        if left <= x < left + width and top <= y < top + height:
+            return i
+    return None
+
+
+def split_text_detections(detections, boxes, sheetSize):
+    # Maps each detection to the tile under the centre of its bounding box and
+    # re-expresses the box relative to that tile.
+    sheetWidth, sheetHeight = sheetSize
+    tiles = [[] for _ in boxes]
+    for detection in detections:
+        box = detection['Geometry']['BoundingBox']
+        x = (box['Left'] + box['Width'] / 2) * sheetWidth
+        y = (box['Top'] + box['Height'] / 2) * sheetHeight
+        i = find_tile(boxes, x, y)
+        if i is None:
+            continue
+        left, top, width, height = boxes[i]
+        tileDetection = dict(detection)
+        tileDetection['Geometry'] = {'BoundingBox': {
+            'Left': (box['Left'] * sheetWidth - left) / width,
+            'Top': (box['Top'] * sheetHeight - top) / height,
+            'Width': box['Width'] * sheetWidth / width,
+            'Height': box['Height'] * sheetHeight / height,
+        }}
+        tiles[i].append(tileDetection)
+    return tiles
+
+
+def is_word_limit_reached(detections):
+    return sum(1 for d in detections if d['Type'] == 'WORD') >= maxWordsPerImage
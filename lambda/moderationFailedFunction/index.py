@@ -13,8 +13,8 @@ def isObjectExist(contentLibraryBucket, key):
     return 'Contents' in results
 
 
-def lambda_handler(event, context):
-    message = event['Records'][0]['Sns']['Message']
+def handle_failure(record, workspace):
+    message = record['Sns']['Message']
     print("From SNS: " + message)
     data = json.loads(message)
 
@@ -33,3 +33,7 @@ def lambda_handler(event, context):
     dynamodb.put_item(TableName=os.environ['moderationResultTableName'],
                       Item={'key': {'S': key}, 'subKey': {'S': subKey}, 'details': {'S': details}})
     return message
+
+
+def lambda_handler(event, context):
+    return process_records(event, handle_failure)
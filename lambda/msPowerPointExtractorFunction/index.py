@@ -1,46 +1,122 @@
 import json
 import urllib.parse
 import os
-from pptx import Presentation
+import posixpath
+import zipfile
+from xml.etree import ElementTree
 from common import *
 
 print('Loading function')
 
+drawingNs = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+presentationNs = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+relationshipNs = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+notesSlideType = relationshipNs.strip('{}') + '/notesSlide'
+# Placeholders on notes pages that only repeat the slide.
+notesPlaceholders = ('sldImg', 'sldNum')
 
-def extract_text(file_path):
-    prs = Presentation(file_path)
-    texts = {}
-    slideNumber = 1
-    for slide in prs.slides:
-        slideTexts = []
-        for shape in slide.shapes:
-            if hasattr(shape, "text"):
-                print(shape.text)
-                slideTexts.append(shape.text)
-        texts[slideNumber] = "/n".join(slideTexts)
-        slideNumber += 1
-    print(texts)
-    filename, file_extension = os.path.splitext(file_path)
-    output_file = os.path.join(os.path.dirname(
-        file_path), filename + "/pptx/extract_text.json")
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(texts, f)
 
+def get_rels(archive, name):
+    folder, basename = posixpath.split(name)
+    try:
+        with archive.open(posixpath.join(folder, '_rels', basename + '.rels')) as rels:
+            root = ElementTree.parse(rels).getroot()
+    except KeyError:
+        return {}
+    targets = {}
+    for rel in root:
+        if rel.get('TargetMode') == 'External':
+            continue
+        target = rel.get('Target')
+        if target.startswith('/'):
+            target = target[1:]
+        else:
+            target = posixpath.normpath(posixpath.join(folder, target))
+        targets[rel.get('Id')] = (rel.get('Type'), target)
+    return targets
 
-def lambda_handler(event, context):
-    clean_tmp()
+
+def get_slide_names(archive):
+    rels = get_rels(archive, 'ppt/presentation.xml')
+    with archive.open('ppt/presentation.xml') as presentation:
+        for event, elem in ElementTree.iterparse(presentation):
+            if elem.tag == presentationNs + 'sldId':
+                yield rels[elem.get(relationshipNs + 'id')][1]
+
+
+def get_notes_name(archive, slideName):
+    for relType, target in get_rels(archive, slideName).values():
+        if relType == notesSlideType:
+            return target
+    return None
+
+
+def iter_paragraphs(archive, name, skipPlaceholders=()):
+    # Shapes, groups, tables and notes all keep their text in a:p paragraphs,
+    # so one pass over the part finds it without building the object model.
+    shapes = []
+    paragraph = []
+    with archive.open(name) as part:
+        for event, elem in ElementTree.iterparse(part, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == presentationNs + 'sp':
+                    shapes.append(None)
+                continue
+            if elem.tag == presentationNs + 'ph' and shapes:
+                shapes[-1] = elem.get('type', 'body')
+            elif elem.tag == drawingNs + 't':
+                paragraph.append(elem.text or '')
+            elif elem.tag == drawingNs + 'br':
+                paragraph.append('\n')
+            elif elem.tag == drawingNs + 'p':
+                text = ''.join(paragraph)
+                paragraph = []
+                if text.strip() and not (shapes and shapes[-1] in skipPlaceholders):
+                    yield text
+                elem.clear()
+            elif elem.tag == presentationNs + 'sp':
+                shapes.pop()
+                elem.clear()
+
+
+def extract_text(pptx_file, key, workspace, uploader):
+    # Slides are written to extract_text.json one at a time, so memory stays
+    # proportional to the largest slide rather than the deck.
+    path = os.path.join(workspace, 'extract_text.json')
+    slideCount = 0
+    with zipfile.ZipFile(pptx_file) as archive, open(path, 'w') as output:
+        output.write('{')
+        for slideNumber, slideName in enumerate(get_slide_names(archive), 1):
+            texts = list(iter_paragraphs(archive, slideName))
+            notesName = get_notes_name(archive, slideName)
+            if notesName is not None:
+                texts.extend(iter_paragraphs(archive, notesName, notesPlaceholders))
+            if slideNumber > 1:
+                output.write(', ')
+            output.write('%s: %s' % (json.dumps(str(slideNumber)),
+                                     json.dumps('\n'.join(texts))))
+            slideCount = slideNumber
+        output.write('}')
+    print('%d slides extracted' % slideCount)
+    uploader.put_file(path, get_artifact_prefix(key, "pptx") + "extract_text.json")
+
+
+def extract_record(record, workspace):
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    bucket, key = get_s3_object(record)
     try:
-        file_path = save_file(bucket, key)
-        extract_media(file_path, 'ppt/media/')
-        extract_text(file_path)
-        os.remove(file_path)
-        copy_tmp_to_processing_bucket()
+        with S3RangeFile(bucket, key) as pptx_file, ArtifactUploader() as uploader:
+            imageFilter = ImageFilter()
+            upload_media(pptx_file, 'ppt/media/', key, uploader, imageFilter)
+            extract_text(pptx_file, key, workspace, uploader)
+        write_manifest(key, uploader.manifest)
+        emit_metrics(imageFilter.stats())
         return 'OK'
     except Exception as e:
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
+
+
+def lambda_handler(event, context):
+    return process_records(event, extract_record)
@@ -1,35 +1,109 @@
+import json
+import re
 import urllib.parse
 import os
-import docx2txt
+import zipfile
+from xml.etree import ElementTree
 from common import *
 
 print('Loading function')
 
+wordNs = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+textParts = re.compile(r'word/(document|header\d*|footer\d*|footnotes|endnotes)\.xml$')
 
-def extract_text(word_file_path):
-    # Refernce: https://github.com/ankushshah89/python-docx2txt
-    text = docx2txt.process(word_file_path)
-    filename, file_extension = os.path.splitext(word_file_path)
-    output_file = os.path.join(os.path.dirname(
-        word_file_path), filename + "/docx/extract_text.txt")
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(text)
 
+def iter_pages(part):
+    # Splits a part into pages of paragraphs on explicit and rendered page
+    # breaks and on section ends, parsing one paragraph at a time.
+    page = []
+    paragraph = []
+    sectionEnd = False
+    for event, elem in ElementTree.iterparse(part):
+        tag = elem.tag
+        if tag == wordNs + 't':
+            paragraph.append(elem.text or '')
+        elif tag == wordNs + 'tab' and elem.get(wordNs + 'pos') is None:
+            # w:tab with a position is a tab stop definition, not text.
+            paragraph.append('\t')
+        elif (tag == wordNs + 'br' and elem.get(wordNs + 'type') == 'page') or tag == wordNs + 'lastRenderedPageBreak':
+            page.append(''.join(paragraph))
+            paragraph = []
+            # Word often writes a rendered break right after an explicit one.
+            if any(p.strip() for p in page):
+                yield page
+                page = []
+        elif tag in (wordNs + 'br', wordNs + 'cr'):
+            paragraph.append('\n')
+        elif tag == wordNs + 'sectPr':
+            sectionEnd = True
+        elif tag == wordNs + 'p':
+            page.append(''.join(paragraph))
+            paragraph = []
+            elem.clear()
+            if sectionEnd:
+                yield page
+                page = []
+                sectionEnd = False
+    page.append(''.join(paragraph))
+    yield page
 
-def lambda_handler(event, context):
-    clean_tmp()
+
+def get_text(paragraphs):
+    return '\n'.join(p for p in paragraphs if p.strip())
+
+
+def extract_docx(word_file, key, workspace, uploader, imageFilter):
+    # Text parts and media are handled in the same walk over the archive.
+    # Document pages are written to extract_text.json as they are parsed, and
+    # headers, footers and notes become one segment each.
+    outputPrefix = get_artifact_prefix(key)
+    path = os.path.join(workspace, 'extract_text.json')
+    segments = []
+    with zipfile.ZipFile(word_file) as archive, open(path, 'w') as output:
+        output.write('{')
+        for member in archive.infolist():
+            if member.is_dir():
+                continue
+            if member.filename.startswith('word/media/'):
+                upload_member(archive, member, outputPrefix, uploader, imageFilter)
+                continue
+            match = textParts.match(member.filename)
+            if match is None:
+                continue
+            with archive.open(member) as part:
+                if match.group(1) == 'document':
+                    texts = ((str(number), get_text(page))
+                             for number, page in enumerate(iter_pages(part), 1))
+                else:
+                    texts = [(match.group(1), get_text(
+                        p for page in iter_pages(part) for p in page))]
+                for name, text in texts:
+                    if not text:
+                        continue
+                    if segments:
+                        output.write(', ')
+                    output.write('%s: %s' % (json.dumps(name), json.dumps(text)))
+                    segments.append(name)
+        output.write('}')
+    print('%d text segments extracted' % len(segments))
+    uploader.put_file(path, get_artifact_prefix(key, "docx") + "extract_text.json")
+
+
+def extract_record(record, workspace):
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    bucket, key = get_s3_object(record)
     try:
-        file_path = save_file(bucket, key)
-        extract_media(file_path, 'word/media/')
-        extract_text(file_path)
-        os.remove(file_path)
-        copy_tmp_to_processing_bucket()
+        with S3RangeFile(bucket, key) as word_file, ArtifactUploader() as uploader:
+            imageFilter = ImageFilter()
+            extract_docx(word_file, key, workspace, uploader, imageFilter)
+        write_manifest(key, uploader.manifest)
+        emit_metrics(imageFilter.stats())
         return 'OK'
     except Exception as e:
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
+
+
+def lambda_handler(event, context):
+    return process_records(event, extract_record)
@@ -25,10 +25,8 @@ def create_presigned_url(bucket_name, object_name, expiration=3600):
     return response
 
 
-def lambda_handler(event, context):
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+def notify(record, workspace):
+    bucket, key = get_s3_object(record)
 
     url = create_presigned_url(bucket, key)
 
@@ -40,3 +38,7 @@ def lambda_handler(event, context):
         MessageStructure='json'
     )
     print(response)
+
+
+def lambda_handler(event, context):
+    return process_records(event, notify)
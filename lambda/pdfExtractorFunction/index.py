@@ -1,31 +1,24 @@
 import urllib.parse
 import os
+import io
 import fitz
+import boto3
 from common import *
 from pathlib import Path
+import multiprocessing
+from PIL import Image
 
 print('Loading function')
 
-dimlimit = 0  # 100  # each image side must be greater than this
-relsize = 0  # 0.05  # image : image size ratio must be larger than this (5%)
-abssize = 0  # 2048  # absolute image size limit 2 KB: ignore if smaller
+pdfWorkers = int(os.environ.get('pdfWorkers', os.cpu_count() or 1))
+minPagesPerWorker = int(os.environ.get('pdfMinPagesPerWorker', '8'))
+# One of auto, native, jpeg, png or legacy (PyMuPDF PNG/PAM, the old output).
+pdfImageEncoding = os.environ.get('pdfImageEncoding', 'auto')
+pdfJpegQuality = int(os.environ.get('pdfJpegQuality', '85'))
+pdfPngCompressLevel = int(os.environ.get('pdfPngCompressLevel', '1'))
 
 
-def extract_text(pdf_file_path):
-    filename, file_extension = os.path.splitext(pdf_file_path)
-    output_file = os.path.join(os.path.dirname(
-        pdf_file_path), filename + "/pdf/extract_text.txt")
-    with open(output_file, 'wb') as f:
-        doc = fitz.open(pdf_file_path)
-        for page in doc:
-            blocks = page.get_text("blocks")
-            blocks.sort(key=lambda b: (b[1], b[0]))
-            for b in blocks:
-                f.write(b[4].encode("utf-8"))
-        f.close()
-
-
-def recoverpix(doc, item):
+def recoverpix_legacy(doc, item):
     xref = item[0]  # xref of PDF image
     smask = item[1]  # xref of its /SMask
 
@@ -58,65 +51,210 @@ def recoverpix(doc, item):
     return doc.extract_image(xref)
 
 
-def extract_pdf_media(pdf_file_path):
-    filename, file_extension = os.path.splitext(pdf_file_path)
-    imgdir = os.path.join(os.path.dirname(
-        pdf_file_path), filename + "/pdf/")
-    doc = fitz.open(pdf_file_path)
-    page_count = doc.page_count  # number of pages
-    xreflist = []
-    imglist = []
-    for pno in range(page_count):
-        il = doc.get_page_images(pno)
-        imglist.extend([x[0] for x in il])
-        for img in il:
+def get_stream_filter(doc, xref):
+    kind, value = doc.xref_get_key(xref, "Filter")
+    return value if kind != "null" else ""
+
+
+def get_pixmap(doc, item):
+    xref = item[0]
+    smask = item[1]
+    pix = fitz.Pixmap(doc, xref)
+    # CMYK, Lab and friends are converted, Rekognition only reads RGB or gray.
+    if pix.colorspace is not None and pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    if smask > 0 and not pix.alpha:
+        pix = fitz.Pixmap(pix, fitz.Pixmap(doc, smask))
+    return pix
+
+
+def encode_pixmap(pix, ext):
+    n = pix.n - pix.alpha
+    if ext == "jpeg" and pix.alpha:
+        # JPEG has no alpha channel.
+        pix = fitz.Pixmap(pix, 0)
+    mode = "L" if n == 1 else "RGB"
+    if pix.alpha:
+        mode += "A"
+    image = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+    output = io.BytesIO()
+    if ext == "jpeg":
+        image.save(output, format="JPEG", quality=pdfJpegQuality)
+    else:
+        image.save(output, format="PNG", compress_level=pdfPngCompressLevel)
+    return {
+        "ext": ext,
+        "colorspace": n,
+        "image": output.getvalue(),
+    }
+
+
+def recoverpix(doc, item, mode=None):
+    # native passes RGB or gray JPEG streams through untouched and writes the
+    # rest as low compression PNG, jpeg writes the rest as JPEG, png always
+    # writes low compression PNG, and auto writes JPEG for photographic (DCT or
+    # JPX) images without transparency and PNG otherwise.
+    mode = mode or pdfImageEncoding
+    if mode == "legacy":
+        return recoverpix_legacy(doc, item)
+    xref = item[0]
+    smask = item[1]
+    streamFilter = get_stream_filter(doc, xref)
+    if mode != "png" and smask == 0 and "DCTDecode" in streamFilter:
+        image = doc.extract_image(xref)
+        if image["ext"] == "jpeg" and image["colorspace"] in (1, 3):
+            return image
+    pix = get_pixmap(doc, item)
+    if pix.colorspace is None:
+        # Stencil masks have no colour channels to encode.
+        return recoverpix_legacy(doc, item)
+    photographic = "DCTDecode" in streamFilter or "JPXDecode" in streamFilter
+    if mode == "jpeg" or (mode == "auto" and photographic and not pix.alpha):
+        return encode_pixmap(pix, "jpeg")
+    return encode_pixmap(pix, "png")
+
+
+def get_image_owners(doc):
+    # Assign every image to the first page that uses it, so each xref is
+    # extracted and uploaded exactly once even when page ranges run in parallel.
+    owners = {}
+    for pno in range(doc.page_count):
+        for img in doc.get_page_images(pno):
+            owners.setdefault(img[0], pno)
+    return owners
+
+
+def extract_page_range(doc, outputPrefix, uploader, start, stop, owners, imageFilter):
+    texts = []
+    extracted = set()
+    for pno in range(start, stop):
+        page = doc[pno]
+        blocks = page.get_text("blocks")
+        blocks.sort(key=lambda b: (b[1], b[0]))
+        texts.append("".join(b[4] for b in blocks))
+        for img in doc.get_page_images(pno):
             xref = img[0]
-            if xref in xreflist:
+            if owners.get(xref) != pno or xref in extracted:
                 continue
             width = img[2]
             height = img[3]
-            if min(width, height) <= dimlimit:
+            # Skip decoding images the filter would drop on size alone.
+            if min(width, height) < imageFilter.minDimension:
+                imageFilter.drop(b"")
                 continue
             image = recoverpix(doc, img)
-            n = image["colorspace"]
-            imgdata = image["image"]
-
-            if len(imgdata) <= abssize:
-                continue
-            if len(imgdata) / (width * height * n) <= relsize:
+            filtered = imageFilter.apply(image["image"], "img%05i.%s" % (xref, image["ext"]),
+                                         width, height, image["colorspace"])
+            if filtered is None:
                 continue
-            imgfile = os.path.join(imgdir, "img%05i.%s" % (xref, image["ext"]))
-            fout = open(imgfile, "wb")
-            fout.write(imgdata)
-            fout.close()
-            xreflist.append(xref)
-
-    imglist = list(set(imglist))
-    print(len(set(imglist)), "images in total")
-    print(len(xreflist), "images extracted")
+            imgdata, name = filtered
+            uploader.put_bytes(outputPrefix + name, imgdata, mediaBucket)
+            extracted.add(xref)
+    return texts, extracted
 
 
-def lambda_handler(event, context):
-    clean_tmp()
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+def run_page_range(conn, pdf_file_path, outputPrefix, start, stop, owners):
     try:
-        file_path = save_file(bucket, key)
+        doc = fitz.open(pdf_file_path)
+        # Each worker process needs its own boto3 client.
+        uploader = ArtifactUploader(s3_client=boto3.client('s3'))
+        imageFilter = ImageFilter()
+        try:
+            texts, extracted = extract_page_range(
+                doc, outputPrefix, uploader, start, stop, owners, imageFilter)
+        finally:
+            manifest = uploader.close()
+        check_uploads(manifest)
+        conn.send((True, (texts, extracted, imageFilter.stats(), manifest)))
+    except Exception as e:
+        conn.send((False, repr(e)))
+    finally:
+        conn.close()
+
+
+def get_page_ranges(page_count, workers):
+    if page_count == 0:
+        return []
+    workers = max(1, min(workers, page_count // minPagesPerWorker))
+    size = -(-page_count // workers)
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
 
-        filename, file_extension = os.path.splitext(file_path)
-        output_dir = os.path.join(os.path.dirname(
-            file_path), filename + "/pdf/")
-        Path(output_dir).mkdir(parents=True, exist_ok=True)
+def extract_pdf(pdf_file_path, key, uploader, imageFilter):
+    outputPrefix = get_artifact_prefix(key, "pdf")
+    doc = fitz.open(pdf_file_path)
+    owners = get_image_owners(doc)
+    ranges = get_page_ranges(doc.page_count, pdfWorkers)
+    # Uploads made by worker processes, the caller's uploader has the rest.
+    uploads = []
+    if len(ranges) <= 1:
+        results = [extract_page_range(doc, outputPrefix, uploader, start, stop, owners, imageFilter)
+                   for start, stop in ranges]
+    else:
+        doc.close()
+        # Lambda has no /dev/shm, so multiprocessing.Pool and Queue cannot be
+        # used there; each worker reports back through its own Pipe instead.
+        # Workers are spawned rather than forked: this runs on a record thread
+        # while upload threads may hold botocore or stdout locks.
+        context = multiprocessing.get_context('spawn')
+        workers = []
+        for start, stop in ranges:
+            parent_conn, child_conn = context.Pipe(duplex=False)
+            rangeOwners = {xref: pno for xref, pno in owners.items()
+                           if start <= pno < stop}
+            process = context.Process(target=run_page_range,
+                                      args=(child_conn, pdf_file_path, outputPrefix, start, stop, rangeOwners))
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn))
+        results = []
+        errors = []
+        for process, parent_conn in workers:
+            try:
+                ok, result = parent_conn.recv()
+            except EOFError:
+                ok, result = False, "worker exited with code %s" % process.exitcode
+            process.join()
+            if ok:
+                texts, extracted, stats, manifest = result
+                imageFilter.merge(stats)
+                uploads.extend(manifest)
+                results.append((texts, extracted))
+            else:
+                errors.append(result)
+        if errors:
+            raise Exception("PDF extraction failed: " + "; ".join(errors))
+
+    xreflist = set()
+    text = []
+    for texts, extracted in results:
+        text.extend(texts)
+        xreflist |= extracted
+    uploader.put_bytes(outputPrefix + "extract_text.txt",
+                       "".join(text).encode("utf-8"))
+    print(len(ranges), "page ranges")
+    print(len(owners), "images in total")
+    print(len(xreflist), "images extracted")
+    return uploads
 
-        extract_text(file_path)
-        extract_pdf_media(file_path)
 
+def extract_record(record, workspace):
+    # Get the object from the event and show its content type
+    bucket, key = get_s3_object(record)
+    try:
+        file_path = save_file(bucket, key, workspace)
+        imageFilter = ImageFilter()
+        with ArtifactUploader() as uploader:
+            uploads = extract_pdf(file_path, key, uploader, imageFilter)
         os.remove(file_path)
-        copy_tmp_to_processing_bucket()
+        write_manifest(key, uploader.manifest + uploads)
+        emit_metrics(imageFilter.stats())
         return 'OK'
     except Exception as e:
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
+
+
+def lambda_handler(event, context):
+    return process_records(event, extract_record)
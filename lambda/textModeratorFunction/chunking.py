@@ -0,0 +1,156 @@
+import json
+import os
+import re
+from collections import OrderedDict, deque
+
+# Words are a conservative stand-in for model tokens: RoBERTa BPE averages about
+# 1.3 tokens per English word, so 160 words stay inside the 256-token limit.
+windowTokens = int(os.environ.get('chunkWindowTokens', '160'))
+overlapTokens = int(os.environ.get('chunkOverlapTokens', '32'))
+scanBatchSize = int(os.environ.get('scanBatchSize', '256'))
+transcriptSegmentSeconds = float(os.environ.get('transcriptSegmentSeconds', '30'))
+sentenceEnds = ('.', '?', '!')
+# Transcribe writes results.items after the full transcript string. A raw
+# quote cannot occur inside a JSON string, so this only matches a key.
+transcriptItemsPattern = re.compile(r'"items"\s*:\s*\[')
+jsonReadSize = 1 << 16
+
+# Text without spaces (CJK, URLs, base64) tokenizes much more densely than
+# English words. CJK characters are matched one at a time and count as two
+# words. Other runs are cut into pieces of at most 32 characters, and pieces
+# longer than 12 characters count as one word per 4 characters.
+cjkRanges = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+tokenPattern = re.compile(r'[%s]|[^\s%s]{1,32}' % (cjkRanges, cjkRanges))
+cjkPattern = re.compile(r'[%s]' % cjkRanges)
+
+
+def get_word_cost(word):
+    if cjkPattern.match(word):
+        return 2
+    if len(word) <= 12:
+        return 1
+    return -(-len(word) // 4)
+
+
+def iter_windows(text, size=windowTokens, overlap=overlapTokens):
+    step = max(size - overlap, 1)
+    spans = deque()
+    total = 0
+    fresh = 0
+    for match in tokenPattern.finditer(text):
+        cost = get_word_cost(match.group())
+        if spans and total + cost > size:
+            yield spans[0][0], spans[-1][1]
+            fresh = 0
+            dropped = 0
+            while spans and (dropped < step or total + cost > size):
+                start, end, spanCost = spans.popleft()
+                total -= spanCost
+                dropped += spanCost
+        spans.append((match.start(), match.end(), cost))
+        total += cost
+        fresh += 1
+    if fresh:
+        yield spans[0][0], spans[-1][1]
+
+
+def iter_json_array(file, pattern=transcriptItemsPattern, readSize=jsonReadSize):
+    # Yields the elements of the first JSON array whose opening matches
+    # pattern, decoding them one at a time so the whole document is never
+    # held in memory. Yields nothing if the pattern is not found.
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        match = pattern.search(buffer)
+        if match:
+            break
+        chunk = file.read(readSize)
+        if not chunk:
+            return
+        # Keep a tail in case the key is split across two reads.
+        buffer = buffer[-64:] + chunk
+    buffer = buffer[match.end():]
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError('Need more data')
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = file.read(readSize)
+            if not chunk:
+                raise ValueError('Unterminated JSON array')
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+
+
+def iter_transcript_segments(items, maxSeconds=transcriptSegmentSeconds, maxWords=windowTokens):
+    # Groups Transcribe items into sentences, cut early at maxSeconds or
+    # maxWords, and yields ((index, startTime, endTime), text) units for scan.
+    words = []
+    startTime = endTime = None
+    index = 0
+    for item in items:
+        content = item['alternatives'][0]['content']
+        if item['type'] == 'punctuation':
+            if words:
+                words[-1] += content
+            if content in sentenceEnds and words:
+                yield (index, startTime, endTime), ' '.join(words)
+                index += 1
+                words = []
+            continue
+        itemStart = float(item['start_time'])
+        if words and (itemStart - startTime >= maxSeconds or len(words) >= maxWords):
+            yield (index, startTime, endTime), ' '.join(words)
+            index += 1
+            words = []
+        if not words:
+            startTime = itemStart
+        endTime = float(item['end_time'])
+        words.append(content)
+    if words:
+        yield (index, startTime, endTime), ' '.join(words)
+
+
+def scan(units, score_fn, batchSize=scanBatchSize):
+    # Streams (source, text) units through overlapping windows and batched
+    # scoring, yielding (source, {name: best window}) as each source completes.
+    pending = OrderedDict()
+    batch = []
+
+    def score_batch():
+        results = score_fn([window[3] for window in batch])
+        for name, scores in results.items():
+            for (source, start, end, text), score in zip(batch, scores):
+                best = pending[source].get(name)
+                if best is None or score > best['score']:
+                    pending[source][name] = {
+                        'score': float(score), 'start': start, 'end': end, 'text': text}
+        batch.clear()
+
+    def completed(current=None):
+        while pending:
+            source = next(iter(pending))
+            if source == current:
+                break
+            best = pending.pop(source)
+            if best:
+                yield source, best
+
+    for source, text in units:
+        pending[source] = {}
+        for start, end in iter_windows(text):
+            batch.append((source, start, end, text[start:end]))
+            if len(batch) >= batchSize:
+                score_batch()
+                yield from completed(source)
+    if batch:
+        score_batch()
+    yield from completed()
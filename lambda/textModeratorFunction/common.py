@@ -4,29 +4,87 @@ import boto3
 import botocore
 import os
 import shutil
-import glob
-import zipfile
-from pathlib import Path
+import tempfile
+import traceback
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 
 s3 = boto3.client('s3')
 
+recordConcurrency = int(os.environ.get('recordConcurrency', '4'))
 
-def clean_tmp():
-    folder = '/tmp/'
-    for filename in os.listdir(folder):
-        file_path = os.path.join(folder, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
+workspaceRoot = '/tmp/workspaces'
+workspaceQuota = int(os.environ.get('workspaceQuotaMb', '0')) * 1024 * 1024
+
+metricNamespace = os.environ.get('metricNamespace', 'AwsAiContentLibrary')
+
+
+class WorkspaceQuotaExceeded(Exception):
+    pass
+
+
+class Workspace:
+    # Private scratch directory for one record under workspaceRoot, removed
+    # when the context exits. Usage is checked against a quota so that
+    # concurrent records cannot exhaust the function's ephemeral storage.
+    # Without workspaceQuotaMb the disk is shared between the records that
+    # actually run at the same time, so a single record gets all of it.
+    def __init__(self, name='record', quota=None, concurrent=1):
+        os.makedirs(workspaceRoot, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=name + '-', dir=workspaceRoot)
+        self.quota = quota or workspaceQuota or (
+            shutil.disk_usage(workspaceRoot).total // max(concurrent, 1))
+
+    def __fspath__(self):
+        return self.path
+
+    def __str__(self):
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def usage(self):
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                total += os.path.getsize(os.path.join(root, name))
+        return total
+
+    def reserve(self, size):
+        usage = self.usage()
+        if usage + size > self.quota:
+            raise WorkspaceQuotaExceeded('Workspace %s needs %d bytes but only %d of %d are free' % (
+                self.path, size, self.quota - usage, self.quota))
+
+
+def clean_workspaces():
+    # Only one invocation runs per container at a time, so anything left in
+    # workspaceRoot belongs to an earlier invocation that did not clean up.
+    if os.path.isdir(workspaceRoot):
+        for filename in os.listdir(workspaceRoot):
+            file_path = os.path.join(workspaceRoot, filename)
+            try:
                 shutil.rmtree(file_path)
-        except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
+            except Exception as e:
+                print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
-def save_file(bucket, key):
+def save_file(bucket, key, folder):
     try:
-        word_file_path = os.path.join("/tmp/", key)
+        word_file_path = os.path.join(folder, key)
+        if isinstance(folder, Workspace):
+            folder.reserve(s3.head_object(
+                Bucket=bucket, Key=key)['ContentLength'])
         os.makedirs(os.path.dirname(word_file_path), exist_ok=True)
         s3.download_file(Bucket=bucket, Key=key, Filename=word_file_path)
         return word_file_path
@@ -37,30 +95,6 @@ def save_file(bucket, key):
             raise
 
 
-def extract_media(file_path, prefix):
-    archive = zipfile.ZipFile(file_path)
-    for file in archive.filelist:
-        if file.filename.startswith(prefix):
-            filename, file_extension = os.path.splitext(file_path)
-            file_extension = file_extension[1:]
-            extract_media_file_dir = os.path.join(filename, file_extension)
-            os.makedirs(os.path.dirname(extract_media_file_dir), exist_ok=True)
-            archive.extract(file, path=extract_media_file_dir)
-
-
-def copy_tmp_to_processing_bucket():
-    print('copy_tmp_to_processing_bucket')
-    processingBucket = os.environ['processingBucket']
-    for path in Path("/tmp/").rglob('*.*'):
-        print(path)
-        if os.path.isfile(path):
-            s3.upload_file(
-                Filename=str(path),
-                Bucket=processingBucket,
-                Key=str(path)[len("/tmp/"):],
-            )
-
-
 def get_source_file_and_moderate_content(filePathName):
     safe_filename = filePathName.replace("(_!AT!_)", '@')
     safe_filename = safe_filename.replace("(_!SPACE!_)", ' ')
@@ -86,3 +120,215 @@ def get_moderate_content_key(key, ext):
         return filePathName + "." + ext
     else:
         return key + "/subType/" + filePathName + "." + ext
+
+
+def emit_metrics(metrics, unit='Count', dimensions=None):
+    # CloudWatch Embedded Metric Format, picked up from the function log.
+    dimensions = dimensions or {
+        'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': metricNamespace,
+                'Dimensions': [list(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': unit} for name in metrics],
+            }],
+        },
+    }
+    record.update(dimensions)
+    record.update(metrics)
+    print(json.dumps(record))
+
+
+throttleErrorCodes = ('Throttling', 'ThrottlingException', 'ThrottledException',
+                      'TooManyRequestsException', 'RequestLimitExceeded',
+                      'ProvisionedThroughputExceededException', 'LimitExceededException')
+
+
+def get_error_kind(e):
+    # Returns 'throttle' or 'transient' for errors worth retrying, else None.
+    # Connection failures and read timeouts are the errors botocore's own
+    # retries covered before limited_client turned them off.
+    if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return 'transient'
+    if not isinstance(e, botocore.exceptions.ClientError):
+        return None
+    code = e.response.get('Error', {}).get('Code')
+    status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    if code in throttleErrorCodes or status == 429:
+        return 'throttle'
+    if status >= 500:
+        return 'transient'
+    return None
+
+
+class AdaptiveLimiter:
+    # AIMD concurrency limit for one AWS service: each success raises the limit
+    # by 1/limit (about +1 per round of calls), each throttle halves it and
+    # other failures leave it alone. Throttled, 5xx and connection failures
+    # are retried with full jitter backoff.
+    def __init__(self, name, initial=4, minimum=1, maximum=32,
+                 maxAttempts=6, backoffBase=0.2, backoffCap=10):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+        self.active = 0
+        self.condition = threading.Condition()
+        self.counters = {'Calls': 0, 'Throttles': 0, 'Retries': 0}
+        self.queueWaits = []
+
+    def acquire(self):
+        start = time.time()
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+            self.queueWaits.append((time.time() - start) * 1000)
+
+    def release(self, outcome):
+        # outcome is 'success', 'throttle', 'transient' or 'error'.
+        with self.condition:
+            self.active -= 1
+            self.counters['Calls'] += 1
+            if outcome == 'throttle':
+                self.counters['Throttles'] += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            elif outcome == 'success':
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.maxAttempts):
+            self.acquire()
+            outcome = 'error'
+            try:
+                result = fn(*args, **kwargs)
+                outcome = 'success'
+                return result
+            except Exception as e:
+                outcome = get_error_kind(e) or 'error'
+                if outcome == 'error' or attempt == self.maxAttempts - 1:
+                    raise
+            finally:
+                self.release(outcome)
+            with self.condition:
+                self.counters['Retries'] += 1
+            time.sleep(random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt)))
+
+    def stats(self, reset=False):
+        with self.condition:
+            counts = {self.name + name: value for name, value in self.counters.items()}
+            waits = self.queueWaits
+            limit = self.limit
+            if reset:
+                self.counters = dict.fromkeys(self.counters, 0)
+                self.queueWaits = []
+        # The limit is a number of calls, so it goes out with the counts.
+        counts[self.name + 'ConcurrencyLimit'] = limit
+        timings = {}
+        if waits:
+            timings[self.name + 'QueueWaitAvg'] = sum(waits) / len(waits)
+            timings[self.name + 'QueueWaitMax'] = max(waits)
+        return counts, timings
+
+
+class LimitedClient:
+    # Routes the API calls of a boto3 client through an AdaptiveLimiter.
+    def __init__(self, client, limiter):
+        self.client = client
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in ('get_paginator', 'get_waiter', 'can_paginate'):
+            return attr
+        return lambda *args, **kwargs: self.limiter.call(attr, *args, **kwargs)
+
+
+limiters = {}
+limitersLock = threading.Lock()
+
+
+def get_limiter(name):
+    # One limiter per service and execution environment, sized by
+    # <name>Concurrency and <name>MaxConcurrency.
+    with limitersLock:
+        if name not in limiters:
+            limiters[name] = AdaptiveLimiter(
+                name,
+                initial=int(os.environ.get(name + 'Concurrency', '4')),
+                maximum=int(os.environ.get(name + 'MaxConcurrency', '32')))
+        return limiters[name]
+
+
+def limited_client(service, name=None, **kwargs):
+    # botocore retries are turned off so the limiter sees every throttle.
+    config = Config(retries={'mode': 'standard', 'max_attempts': 1})
+    return LimitedClient(boto3.client(service, config=config, **kwargs),
+                         get_limiter(name or service))
+
+
+def emit_limiter_metrics():
+    for limiter in list(limiters.values()):
+        counts, timings = limiter.stats(reset=True)
+        emit_metrics(counts)
+        if timings:
+            emit_metrics(timings, unit='Milliseconds')
+
+
+def get_s3_object(record):
+    bucket = record['s3']['bucket']['name']
+    key = urllib.parse.unquote_plus(
+        record['s3']['object']['key'], encoding='utf-8')
+    return bucket, key
+
+
+def get_records(event):
+    # Yields (itemIdentifier, record) pairs. S3 notifications delivered
+    # through SQS are unwrapped so handlers always see the S3 record.
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            body = json.loads(record['body'])
+            for inner in body.get('Records', []):
+                yield record['messageId'], inner
+        else:
+            yield None, record
+
+
+def get_failure(itemIdentifier, record, e):
+    print('Failed to process record %s. Reason: %s' % (
+        itemIdentifier or json.dumps(record)[:1024], e))
+    return itemIdentifier or e
+
+
+def process_records(event, handle_record, max_workers=recordConcurrency):
+    clean_workspaces()
+    records = list(get_records(event))
+    isQueue = any(itemIdentifier is not None for itemIdentifier, _ in records)
+
+    def run(item):
+        itemIdentifier, record = item
+        try:
+            with Workspace(concurrent=workers) as workspace:
+                handle_record(record, workspace)
+            return None
+        except Exception as e:
+            traceback.print_exc()
+            return get_failure(itemIdentifier, record, e)
+
+    workers = max(1, min(max_workers, len(records)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        failures = [f for f in executor.map(run, records) if f is not None]
+    emit_metrics({'processedRecords': len(records),
+                  'failedRecords': len(failures)})
+    if failures and not isQueue:
+        # Only queue triggers support partial batch responses, so fail the
+        # whole invocation and let Lambda retry it.
+        raise Exception('%d of %d records failed: %s' % (
+            len(failures), len(records), failures[0]))
+    return {'batchItemFailures': [{'itemIdentifier': i} for i in dict.fromkeys(failures)]}
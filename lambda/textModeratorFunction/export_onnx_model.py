@@ -0,0 +1,106 @@
+"""Export the offensive text classifier to a quantized ONNX model.
+
+Used by the model stage of the Dockerfile:
+
+    python export_onnx_model.py --model cardiffnlp/twitter-roberta-base-offensive --output /model
+
+--tiny writes a small random model with a word-level tokenizer instead. It
+needs only onnx and tokenizers and is meant for offline tests.
+"""
+import argparse
+import json
+import os
+import tempfile
+
+
+def export_model(modelId, output):
+    from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    with tempfile.TemporaryDirectory() as exportDir:
+        model = ORTModelForSequenceClassification.from_pretrained(modelId, export=True)
+        model.save_pretrained(exportDir)
+        quantizer = ORTQuantizer.from_pretrained(exportDir)
+        # Dynamic int8 quantization with AVX2 kernels, which every Lambda x86 host has.
+        quantizer.quantize(save_dir=output,
+                           quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+    AutoTokenizer.from_pretrained(modelId).save_pretrained(output)
+
+
+TINY_VOCAB = ["<pad>", "<unk>", "the", "meeting", "starts", "now", "thanks", "everyone",
+              "please", "review", "slides", "damn", "hell", "idiot", "stupid", "hate"]
+TINY_OFFENSIVE = {"damn", "hell", "idiot", "stupid", "hate"}
+
+
+def build_tiny_model(output, dim=8, seed=7):
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+    from tokenizers import Tokenizer
+    from tokenizers.models import WordLevel
+    from tokenizers.pre_tokenizers import Whitespace
+
+    os.makedirs(output, exist_ok=True)
+    vocab = {word: i for i, word in enumerate(TINY_VOCAB)}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.save(os.path.join(output, "tokenizer.json"))
+
+    # Offensive words point along the first embedding axis, which the
+    # classifier maps to LABEL_1.
+    rng = np.random.default_rng(seed)
+    embeddings = rng.normal(0, 0.1, (len(TINY_VOCAB), dim)).astype(np.float32)
+    embeddings[0] = 0
+    for word in TINY_OFFENSIVE:
+        embeddings[vocab[word], 0] = 3.0
+    weights = np.zeros((dim, 2), dtype=np.float32)
+    weights[0] = [-1.0, 1.0]
+    bias = np.array([0.5, -0.5], dtype=np.float32)
+
+    nodes = [
+        helper.make_node("Gather", ["embeddings", "input_ids"], ["tokens"]),
+        helper.make_node("Cast", ["attention_mask"], ["maskFloat"], to=TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["maskFloat", "lastAxis"], ["mask3d"]),
+        helper.make_node("Mul", ["tokens", "mask3d"], ["masked"]),
+        helper.make_node("ReduceSum", ["masked", "tokenAxis"], ["summed"], keepdims=0),
+        helper.make_node("ReduceSum", ["maskFloat", "tokenAxis"], ["counts"], keepdims=1),
+        helper.make_node("Div", ["summed", "counts"], ["pooled"]),
+        helper.make_node("MatMul", ["pooled", "weights"], ["projected"]),
+        helper.make_node("Add", ["projected", "bias"], ["logits"]),
+    ]
+    graph = helper.make_graph(
+        nodes, "tiny-offensive",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "sequence"]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "sequence"])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", 2])],
+        [numpy_helper.from_array(embeddings, "embeddings"),
+         numpy_helper.from_array(weights, "weights"),
+         numpy_helper.from_array(bias, "bias"),
+         numpy_helper.from_array(np.array([-1], dtype=np.int64), "lastAxis"),
+         numpy_helper.from_array(np.array([1], dtype=np.int64), "tokenAxis")])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    # Pin the IR version of opset 13 so older onnxruntime releases load it.
+    model.ir_version = 7
+    onnx.checker.check_model(model)
+    onnx.save(model, os.path.join(output, "model.onnx"))
+
+    with open(os.path.join(output, "config.json"), "w") as f:
+        json.dump({"id2label": {"0": "LABEL_0", "1": "LABEL_1"}, "pad_token_id": 0}, f)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default='cardiffnlp/twitter-roberta-base-offensive')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--tiny', action='store_true')
+    args = parser.parse_args()
+    if args.tiny:
+        build_tiny_model(args.output)
+    else:
+        export_model(args.model, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,30 @@
 import urllib.parse
 import os
-import numpy as np
-from scipy.special import softmax
-import csv
-import urllib.request
+import threading
 from common import *
 from pathlib import Path
 import json
-from profanity_check import predict, predict_prob
-import sagemaker
-
-from sagemaker.huggingface.model import HuggingFaceModel, HuggingFacePredictor
-from sagemaker.serverless import ServerlessInferenceConfig
+import asyncio
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from scoring import score_texts, scoreCache, profanityCache, get_cascade_stats, preload
+from chunking import scan, iter_transcript_segments, iter_json_array
 
 print('Loading function')
 
-
-sess = sagemaker.Session()
-
 threshold = 0.6
+maxReportedSegments = int(os.environ.get('maxReportedSegments', '100'))
+# Endpoint batches of a document are sent batchConcurrency at a time.
+batchConcurrency = int(os.environ.get('batchConcurrency', '8'))
+batchExecutor = ThreadPoolExecutor(max_workers=batchConcurrency)
 
 sns = boto3.client('sns')
 
+# Load the clients and the local model in the background while the container
+# starts; the first request waits for whatever is still loading.
+if os.environ.get('preloadModels', 'true') == 'true':
+    threading.Thread(target=preload, daemon=True).start()
+
 
 def preprocess(text):
     new_text = []
@@ -30,29 +33,6 @@ def preprocess(text):
     return " ".join(new_text)
 
 
-def get_offensive_score(text):
-
-    predictor = HuggingFacePredictor(
-        endpoint_name=os.environ['huggingFaceModelEndpointName'], sagemaker_session=sess)
-    data = {
-        "inputs": text,
-        "parameters": {
-            'truncation': True,
-            'max_length': 256,
-            'padding': True,
-        }
-    }
-    res = predictor.predict(data=data)
-
-    print(res)
-
-    if res[0]['label'] == 'LABEL_1':
-        print(type(res[0]['score']))
-        return res[0]['score']
-    else:
-        return 0
-
-
 def publish_message(key, problem, details):
     source, moderateContent = get_source_file_and_moderate_content(key)
     message = {
@@ -68,61 +48,106 @@ def publish_message(key, problem, details):
     )
 
 
+def get_offending(best):
+    for problem in ['Offensive', 'Profanity']:
+        if problem in best and best[problem]['score'] > threshold:
+            return problem, best[problem]
+    return None, None
+
+
 def handle_text(key, file_path):
-    file = open(file_path, "r", encoding='utf-8')
-    lines = file.readlines()
-    for line in lines:
-        if line:
-            offensiveScore = get_offensive_score(line)
-            profanityScore = predict_prob([line])[0]
-            print(line)
-            if offensiveScore > threshold:
-                details = {'score': offensiveScore, 'text': line}
-                publish_message(key, 'Offensive', details)
-                break
-            if profanityScore > threshold:
-                details = {'score': profanityScore, 'text': line}
-                publish_message(key, 'Profanity', details)
+    with open(file_path, "r", encoding='utf-8') as file:
+        lines = ((lineNumber, line)
+                 for lineNumber, line in enumerate(file, 1) if line.strip())
+        for lineNumber, best in scan(lines, score_texts):
+            problem, window = get_offending(best)
+            if problem:
+                print(window['text'])
+                details = dict(window, line=lineNumber)
+                publish_message(key, problem, details)
                 break
 
 
+def handle_transcript(key, items):
+    # Segments are scored as they are built, and findings carry the time span
+    # of the segment in seconds.
+    findings = {'Offensive': [], 'Profanity': []}
+    segments = iter_transcript_segments(items)
+    for (index, startTime, endTime), best in scan(segments, score_texts):
+        for problem, matches in findings.items():
+            window = best[problem]
+            if window['score'] > threshold:
+                matches.append({'score': window['score'], 'startTime': startTime,
+                                 'endTime': endTime, 'text': window['text']})
+    for problem, matches in findings.items():
+        if len(matches) > 0:
+            print('%d %s segments in %s' % (len(matches), problem, key))
+            # Keep the message within the SNS size limit.
+            matches = sorted(matches, key=lambda m: -m['score'])[:maxReportedSegments]
+            publish_message(key, problem, sorted(matches, key=lambda m: m['startTime']))
+
+
+async def score_pages(pages):
+    # All pages go through one scan, so the scan, profanity and cache batches
+    # stay full size. The scan runs on its own thread and hands each set of
+    # endpoint batches back to the event loop; batchExecutor caps how many run
+    # at once and gather returns them in batch order.
+    loop = asyncio.get_running_loop()
+
+    async def run_batches(fn, batches):
+        return await asyncio.gather(*(loop.run_in_executor(batchExecutor, fn, batch)
+                                      for batch in batches))
+
+    def map_batches(fn, batches):
+        # Blocks until the loop has run the batches, so it must never be
+        # called from the loop thread itself.
+        return asyncio.run_coroutine_threadsafe(run_batches(fn, batches), loop).result()
+
+    # A dedicated thread keeps the blocking scan out of the loop's default
+    # executor.
+    with ThreadPoolExecutor(max_workers=1) as scanExecutor:
+        return await loop.run_in_executor(
+            scanExecutor, lambda: list(scan(pages, lambda texts: score_texts(texts, map_batches))))
+
+
 def handle_json(key, file_path):
-    offensiveDetails = {}
-    profanityDetails = {}
+    # Transcribe items are streamed from the file, since a long recording's
+    # output is far larger than its transcript.
+    with open(file_path) as f:
+        items = iter_json_array(f)
+        first = next(items, None)
+        if first is not None:
+            handle_transcript(key, itertools.chain([first], items))
+            return
     text = Path(file_path).read_text()
     content = json.loads(text)
 
     if 'results' in content and 'transcripts' in content['results']:
         transcript = content['results']['transcripts'][0]['transcript']
-        offensiveScore = get_offensive_score(transcript)
-        profanityScore = predict_prob([transcript])[0]
-        if offensiveScore > threshold:
-            publish_message(key, 'Offensive', offensiveScore)
-        if profanityScore > threshold:
-            publish_message(key, 'Profanity', profanityScore)
+        for _, best in scan([('transcript', transcript)], score_texts):
+            for problem in ['Offensive', 'Profanity']:
+                if best[problem]['score'] > threshold:
+                    publish_message(key, problem, best[problem])
     else:
-        pageToText = content
-        for page, text in pageToText.items():
-            offensiveScore = get_offensive_score(text)
-            profanityScore = predict_prob([text])[0]
-            if offensiveScore > threshold:
-                offensiveDetails[page] = offensiveScore
-            if profanityScore > threshold:
-                profanityDetails[page] = profanityScore
+        offensiveDetails = {}
+        profanityDetails = {}
+        for page, best in asyncio.run(score_pages(list(content.items()))):
+            for problem, details in [('Offensive', offensiveDetails), ('Profanity', profanityDetails)]:
+                window = best[problem]
+                if window['score'] > threshold:
+                    details[page] = {'score': window['score'],
+                                     'start': window['start'], 'end': window['end']}
         if len(offensiveDetails) > 0:
             publish_message(key, 'Offensive', offensiveDetails)
         if len(profanityDetails) > 0:
             publish_message(key, 'Profanity', profanityDetails)
 
 
-def lambda_handler(event, context):
-    clean_tmp()
+def moderate_record(record, workspace):
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    bucket, key = get_s3_object(record)
     try:
-        file_path = save_file(bucket, key)
+        file_path = save_file(bucket, key, workspace)
 
         if key.endswith('.json'):
             print("PPT:" + key)
@@ -135,3 +160,14 @@ def lambda_handler(event, context):
     except Exception as e:
         print(e)
         raise e
+
+
+def lambda_handler(event, context):
+    try:
+        return process_records(event, moderate_record)
+    finally:
+        metrics = scoreCache.stats(reset=True)
+        metrics.update(profanityCache.stats(reset=True))
+        metrics.update(get_cascade_stats(reset=True))
+        emit_metrics(metrics)
+        emit_limiter_metrics()
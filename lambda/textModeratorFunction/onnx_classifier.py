@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+
+
+class OnnxClassifier:
+    # Runs an exported (and usually quantized) sequence classifier on CPU.
+    # Texts are sorted by token count and packed into batches of at most
+    # maxBatchTokens padded tokens, so short texts are not padded to the
+    # longest one in the request.
+    def __init__(self, modelDir, modelFile=None, maxLength=256, maxBatchTokens=8192,
+                 positiveLabel='LABEL_1', threads=None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(modelDir, 'config.json')) as f:
+            config = json.load(f)
+        id2label = {int(i): label for i, label in config.get('id2label', {}).items()}
+        label2id = {label: i for i, label in id2label.items()}
+        self.positiveIndex = label2id.get(positiveLabel, 1)
+        self.padId = config.get('pad_token_id') or 0
+        self.maxBatchTokens = maxBatchTokens
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(modelDir, 'tokenizer.json'))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(maxLength)
+
+        if modelFile is None:
+            modelFile = 'model_quantized.onnx'
+            if not os.path.exists(os.path.join(modelDir, modelFile)):
+                modelFile = 'model.onnx'
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or os.cpu_count() or 1
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(modelDir, modelFile), options, providers=['CPUExecutionProvider'])
+        self.inputNames = {i.name for i in self.session.get_inputs()}
+
+    def get_batches(self, order, lengths):
+        batch = []
+        for i in order:
+            # order is sorted by length, so lengths[i] is the padded length.
+            if batch and (len(batch) + 1) * lengths[i] > self.maxBatchTokens:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def predict_proba(self, texts):
+        encodings = self.tokenizer.encode_batch(list(texts))
+        lengths = [max(len(e.ids), 1) for e in encodings]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+        probs = None
+        for batch in self.get_batches(order, lengths):
+            width = max(lengths[i] for i in batch)
+            ids = np.full((len(batch), width), self.padId, dtype=np.int64)
+            mask = np.zeros((len(batch), width), dtype=np.int64)
+            for row, i in enumerate(batch):
+                n = len(encodings[i].ids)
+                ids[row, :n] = encodings[i].ids
+                mask[row, :max(n, 1)] = 1
+            feed = {'input_ids': ids, 'attention_mask': mask,
+                    'token_type_ids': np.zeros_like(ids)}
+            logits = self.session.run(None, {name: value for name, value in feed.items()
+                                             if name in self.inputNames})[0]
+            exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+            batchProbs = exp / exp.sum(axis=1, keepdims=True)
+            if probs is None:
+                probs = np.zeros((len(texts), batchProbs.shape[1]))
+            probs[batch] = batchProbs
+        return probs if probs is not None else np.zeros((0, 2))
+
+    def get_scores(self, probs):
+        # Same contract as the endpoint's text-classification pipeline: the
+        # positive label's score when it is the top label, otherwise 0.
+        top = probs.argmax(axis=1)
+        return np.where(top == self.positiveIndex, probs[:, self.positiveIndex], 0.0)
+
+    def predict(self, texts):
+        return self.get_scores(self.predict_proba(texts))
@@ -0,0 +1,198 @@
+import hashlib
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import boto3
+import numpy as np
+
+
+def normalize(text):
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def get_cache_key(modelId, text):
+    digest = hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()
+    return modelId + '#' + digest
+
+
+class CacheTier:
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def count(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self, reset=False):
+        with self.lock:
+            stats = {self.name + 'Hits': self.hits,
+                     self.name + 'Misses': self.misses}
+            if reset:
+                self.hits = 0
+                self.misses = 0
+        return stats
+
+
+class LruTier(CacheTier):
+    def __init__(self, maxSize=10000, ttl=3600, name='lruCache'):
+        super().__init__(name)
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.items = OrderedDict()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                item = self.items.get(key)
+                if item is None:
+                    continue
+                score, expiresAt = item
+                if expiresAt <= now:
+                    del self.items[key]
+                    continue
+                self.items.move_to_end(key)
+                found[key] = score
+        self.count(len(found), len(keys) - len(found))
+        return found
+
+    def put_many(self, scores):
+        expiresAt = time.time() + self.ttl
+        with self.lock:
+            for key, score in scores.items():
+                self.items[key] = (score, expiresAt)
+                self.items.move_to_end(key)
+            while len(self.items) > self.maxSize:
+                self.items.popitem(last=False)
+
+
+class InMemoryTier(LruTier):
+    # Local stand-in for DynamoDbTier for tests and offline runs.
+    def __init__(self, ttl=86400, name='sharedCache'):
+        super().__init__(maxSize=float('inf'), ttl=ttl, name=name)
+
+
+class DynamoDbTier(CacheTier):
+    # Unprocessed keys and items are retried with full jitter backoff. After
+    # maxAttempts they are given up on, which only costs cache misses.
+    def __init__(self, tableName, ttl=2592000, client=None, name='sharedCache',
+                 maxAttempts=6, backoffBase=0.05, backoffCap=2):
+        super().__init__(name)
+        self.tableName = tableName
+        self.ttl = ttl
+        self.client = client or boto3.client('dynamodb')
+        self.maxAttempts = maxAttempts
+        self.backoffBase = backoffBase
+        self.backoffCap = backoffCap
+
+    def backoff(self, attempt):
+        if attempt + 1 >= self.maxAttempts:
+            return False
+        time.sleep(random.uniform(0, min(self.backoffCap, self.backoffBase * 2 ** attempt)))
+        return True
+
+    def get_many(self, keys):
+        found = {}
+        now = int(time.time())
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), 100):
+            request = {self.tableName: {
+                'Keys': [{'key': {'S': key}} for key in keys[i:i + 100]],
+                'ProjectionExpression': '#k, score, expiresAt',
+                'ExpressionAttributeNames': {'#k': 'key'},
+            }}
+            attempt = 0
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.tableName, []):
+                    # DynamoDB removes expired items lazily, so check TTL on read.
+                    if int(item['expiresAt']['N']) > now:
+                        found[item['key']['S']] = float(item['score']['N'])
+                request = response.get('UnprocessedKeys')
+                if request and not self.backoff(attempt):
+                    break
+                attempt += 1
+        self.count(len(found), len(keys) - len(found))
+        return found
+
+    def put_many(self, scores):
+        expiresAt = str(int(time.time()) + self.ttl)
+        requests = [{'PutRequest': {'Item': {
+            'key': {'S': key},
+            'score': {'N': repr(float(score))},
+            'expiresAt': {'N': expiresAt},
+        }}} for key, score in scores.items()]
+        for i in range(0, len(requests), 25):
+            request = {self.tableName: requests[i:i + 25]}
+            attempt = 0
+            while request:
+                response = self.client.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems')
+                if request and not self.backoff(attempt):
+                    print('Dropped %d score cache writes' % len(request[self.tableName]))
+                    break
+                attempt += 1
+
+
+class ScoreCache:
+    # The shared tier is only an optimisation: when it fails, the texts are
+    # scored as misses and the error is counted.
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+        self.sharedErrors = 0
+        self.lock = threading.Lock()
+
+    def shared_error(self, operation, error):
+        print('Shared score cache %s failed: %s' % (operation, error))
+        with self.lock:
+            self.sharedErrors += 1
+
+    def get_scores(self, modelId, texts, score_fn):
+        keys = [get_cache_key(modelId, text) for text in texts]
+        scores = self.local.get_many(keys)
+        missing = [key for key in dict.fromkeys(keys) if key not in scores]
+        if missing and self.shared is not None:
+            try:
+                sharedScores = self.shared.get_many(missing)
+            except Exception as e:
+                self.shared_error('read', e)
+                sharedScores = {}
+            self.local.put_many(sharedScores)
+            scores.update(sharedScores)
+            missing = [key for key in missing if key not in sharedScores]
+        if missing:
+            missingSet = set(missing)
+            toScore = {}
+            for key, text in zip(keys, texts):
+                if key in missingSet and key not in toScore:
+                    toScore[key] = text
+            newScores = dict(zip(toScore.keys(),
+                                 (float(s) for s in score_fn(list(toScore.values())))))
+            self.local.put_many(newScores)
+            if self.shared is not None:
+                try:
+                    self.shared.put_many(newScores)
+                except Exception as e:
+                    self.shared_error('write', e)
+            scores.update(newScores)
+        return np.array([scores[key] for key in keys], dtype=float)
+
+    def stats(self, reset=False):
+        stats = self.local.stats(reset)
+        if self.shared is not None:
+            stats.update(self.shared.stats(reset))
+            with self.lock:
+                stats[self.shared.name + 'Errors'] = self.sharedErrors
+                if reset:
+                    self.sharedErrors = 0
+        return stats
@@ -0,0 +1,227 @@
+import json
+import os
+import threading
+import numpy as np
+from score_cache import ScoreCache, LruTier, DynamoDbTier
+from common import limited_client
+
+# Serverless endpoints accept up to 4 MB per request, keep batches well below it.
+batchSize = int(os.environ.get('offensiveBatchSize', '32'))
+batchMaxChars = int(os.environ.get('offensiveBatchMaxChars', '65536'))
+# predict_prob builds a sparse matrix for the whole input, chunk very large documents.
+profanityChunkSize = int(os.environ.get('profanityChunkSize', '5000'))
+
+# Local profanity probabilities below the lower band are trusted as clean and
+# above the upper band as offending; only text in between goes to the endpoint.
+cascadeLowerBand = float(os.environ.get('cascadeLowerBand', '0.02'))
+cascadeUpperBand = float(os.environ.get('cascadeUpperBand', '0.95'))
+cascadeCounters = {'cascadeLocalClean': 0,
+                   'cascadeLocalOffending': 0, 'cascadeRemote': 0,
+                   'backendLocal': 0, 'backendRemote': 0}
+cascadeLock = threading.Lock()
+
+# remote calls the SageMaker endpoint, local runs the exported ONNX model in
+# the container, and hybrid runs locally and sends only texts whose local
+# probability falls between the hybrid bands to the endpoint.
+scoringBackend = os.environ.get('scoringBackend', 'remote')
+onnxModelDir = os.environ.get('onnxModelDir', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'model'))
+onnxMaxBatchTokens = int(os.environ.get('onnxMaxBatchTokens', '8192'))
+hybridLowerBand = float(os.environ.get('hybridLowerBand', '0.2'))
+hybridUpperBand = float(os.environ.get('hybridUpperBand', '0.8'))
+
+offensiveModelId = os.environ.get('huggingFaceModelId', 'huggingFaceModel')
+# The quantized model scores slightly differently, so it gets its own cache keys.
+offensiveCacheId = offensiveModelId if scoringBackend == 'remote' else offensiveModelId + '#' + scoringBackend
+profanityModelId = 'alt-profanity-check'
+
+# Both are created on first use, or by preload while the container starts.
+runtime = None
+predictProb = None
+localModel = None
+runtimeLock = threading.Lock()
+modelLock = threading.Lock()
+localModelLock = threading.Lock()
+
+sharedTier = None
+if os.environ.get('scoreCacheTableName'):
+    sharedTier = DynamoDbTier(os.environ['scoreCacheTableName'],
+                              ttl=int(os.environ.get('scoreCacheTtlSeconds', '2592000')))
+scoreCache = ScoreCache(
+    LruTier(maxSize=int(os.environ.get('scoreCacheSize', '50000')),
+            ttl=int(os.environ.get('scoreCacheLocalTtlSeconds', '3600'))),
+    sharedTier)
+# Local profanity scores cost microseconds, less than a DynamoDB round trip,
+# so they are only kept in process.
+profanityCache = ScoreCache(
+    LruTier(maxSize=int(os.environ.get('scoreCacheSize', '50000')),
+            ttl=int(os.environ.get('scoreCacheLocalTtlSeconds', '3600')),
+            name='profanityCache'))
+
+
+def get_runtime():
+    global runtime
+    with runtimeLock:
+        if runtime is None:
+            # The limiter shapes traffic to the serverless endpoint, whose
+            # MaxConcurrency is small.
+            runtime = limited_client('sagemaker-runtime', 'sagemaker')
+    return runtime
+
+
+def get_predict_prob():
+    global predictProb
+    with modelLock:
+        if predictProb is None:
+            # Importing profanity_check loads scikit-learn and the pickled model.
+            from profanity_check import predict_prob
+            predictProb = predict_prob
+    return predictProb
+
+
+def get_local_model():
+    global localModel
+    with localModelLock:
+        if localModel is None:
+            from onnx_classifier import OnnxClassifier
+            localModel = OnnxClassifier(onnxModelDir, maxBatchTokens=onnxMaxBatchTokens)
+    return localModel
+
+
+def preload():
+    if scoringBackend != 'local':
+        get_runtime()
+    get_predict_prob()
+    if scoringBackend != 'remote':
+        get_local_model()
+
+
+def invoke_endpoint(data):
+    response = get_runtime().invoke_endpoint(
+        EndpointName=os.environ['huggingFaceModelEndpointName'],
+        ContentType='application/json',
+        Accept='application/json',
+        Body=json.dumps(data))
+    return json.loads(response['Body'].read())
+
+
+def get_batches(texts, size=batchSize, maxChars=batchMaxChars):
+    batch = []
+    chars = 0
+    for text in texts:
+        if batch and (len(batch) >= size or chars + len(text) > maxChars):
+            yield batch
+            batch = []
+            chars = 0
+        batch.append(text)
+        chars += len(text)
+    if batch:
+        yield batch
+
+
+def predict_offensive_batch(batch):
+    data = {
+        "inputs": batch,
+        "parameters": {
+            'truncation': True,
+            'max_length': 256,
+            'padding': True,
+        }
+    }
+    res = invoke_endpoint(data)
+    print(res)
+    if len(res) != len(batch):
+        raise ValueError("Expected %d predictions but got %d" %
+                         (len(batch), len(res)))
+    return [r['score'] if r['label'] == 'LABEL_1' else 0 for r in res]
+
+
+def predict_offensive_scores(texts, map_batches=map):
+    # map_batches(fn, batches) must return the results in batch order; callers
+    # pass a concurrent one to overlap the endpoint requests.
+    results = map_batches(predict_offensive_batch, list(get_batches(texts)))
+    return np.array([score for scores in results for score in scores], dtype=float)
+
+
+def count_backend(local, remote):
+    with cascadeLock:
+        cascadeCounters['backendLocal'] += local
+        cascadeCounters['backendRemote'] += remote
+
+
+def predict_remote_scores(texts, map_batches=map):
+    count_backend(0, len(texts))
+    return predict_offensive_scores(texts, map_batches)
+
+
+def predict_local_scores(texts, map_batches=map):
+    count_backend(len(texts), 0)
+    return get_local_model().predict(texts)
+
+
+def predict_hybrid_scores(texts, map_batches=map):
+    model = get_local_model()
+    probs = model.predict_proba(texts)
+    scores = model.get_scores(probs)
+    positive = probs[:, model.positiveIndex]
+    uncertain = np.flatnonzero((positive > hybridLowerBand) & (positive < hybridUpperBand))
+    count_backend(len(texts) - len(uncertain), len(uncertain))
+    if len(uncertain) > 0:
+        scores[uncertain] = predict_offensive_scores([texts[i] for i in uncertain], map_batches)
+    return scores
+
+
+backends = {
+    'remote': predict_remote_scores,
+    'local': predict_local_scores,
+    'hybrid': predict_hybrid_scores,
+}
+
+
+def get_offensive_scores(texts, map_batches=map):
+    return scoreCache.get_scores(offensiveCacheId, texts,
+                                 lambda missing: backends[scoringBackend](missing, map_batches))
+
+
+def get_offensive_score(text):
+    return get_offensive_scores([text])[0]
+
+
+def predict_profanity_scores(texts, chunkSize=profanityChunkSize):
+    if len(texts) == 0:
+        return np.zeros(0)
+    predict_prob = get_predict_prob()
+    return np.concatenate([predict_prob(texts[i:i + chunkSize])
+                           for i in range(0, len(texts), chunkSize)])
+
+
+def get_profanity_scores(texts):
+    return profanityCache.get_scores(profanityModelId, texts, predict_profanity_scores)
+
+
+def score_texts(texts, map_batches=map):
+    profanityScores = get_profanity_scores(texts)
+    offensiveScores = np.zeros(len(texts))
+    clean = profanityScores < cascadeLowerBand
+    offending = profanityScores >= cascadeUpperBand
+    ambiguous = np.flatnonzero(~(clean | offending))
+    if len(ambiguous) > 0:
+        offensiveScores[ambiguous] = get_offensive_scores(
+            [texts[i] for i in ambiguous], map_batches)
+    with cascadeLock:
+        cascadeCounters['cascadeLocalClean'] += int(clean.sum())
+        cascadeCounters['cascadeLocalOffending'] += int(offending.sum())
+        cascadeCounters['cascadeRemote'] += len(ambiguous)
+    return {
+        'Offensive': offensiveScores,
+        'Profanity': profanityScores,
+    }
+
+
+def get_cascade_stats(reset=False):
+    with cascadeLock:
+        stats = dict(cascadeCounters)
+        if reset:
+            for name in cascadeCounters:
+                cascadeCounters[name] = 0
+    return stats
@@ -15,24 +15,19 @@ mediaconvert_client = boto3.client(
     'mediaconvert', endpoint_url=os.environ["MediaconvertEndPoint"])
 
 
-def lambda_handler(event, context):
+def convert_video(record, workspace):
     assetID = str(uuid.uuid4())
-    sourceS3Bucket = event['Records'][0]['s3']['bucket']['name']
-    sourceS3Key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    sourceS3Bucket, sourceS3Key = get_s3_object(record)
     sourceS3 = 's3://' + sourceS3Bucket + '/' + sourceS3Key
     destinationS3 = 's3://' + os.environ['processingBucket']
     mediaConvertRole = os.environ['MediaConvertRole']
     region = os.environ['AWS_DEFAULT_REGION']
-    statusCode = 200
     body = {}
 
     # Use MediaConvert SDK UserMetadata to tag jobs with the assetID
     # Events from MediaConvert will have the assetID in UserMedata
     jobMetadata = {'assetID': assetID}
 
-    print(json.dumps(event))
-
     try:
         # Job settings are in the lambda zip file in the current working directory
         with open('job.json') as json_data:
@@ -65,12 +60,15 @@ def lambda_handler(event, context):
 
     except Exception as e:
         print('Exception: %s' % e)
-        statusCode = 500
         raise
 
-    finally:
-        return {
-            'statusCode': statusCode,
-            'body': json.dumps(body),
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
-        }
+    return {
+        'statusCode': 200,
+        'body': json.dumps(body),
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    }
+
+
+def lambda_handler(event, context):
+    print(json.dumps(event))
+    return process_records(event, convert_video)
@@ -5,18 +5,25 @@ import os
 
 print('Loading function')
 
-rekognition = boto3.client('rekognition')
+rekognition = limited_client('rekognition')
 
 sns = boto3.client('sns')
 
 
-def moderate_video(key, jobId):
+minConfidence = float(os.environ.get('videoMinConfidence', '50'))
+# A label whose name or parent is listed here ends the scan immediately.
+blockingLabels = set(filter(None, (name.strip() for name in os.environ.get(
+    'videoBlockingLabels', 'Explicit Nudity,Violence,Visually Disturbing').split(','))))
+confidenceBandSize = 10
+
+
+def moderate_video(key, summary):
     source, moderateContent = get_source_file_and_moderate_content(key)
     message = {
         'source': source,
         'moderateContent': moderateContent,
         'problem': 'Video',
-        'details': json.dumps({'JobId': jobId})
+        'details': json.dumps(summary)
     }
     response = sns.publish(
         TargetArn=os.environ['moderationTopic'],
@@ -26,34 +33,74 @@ def moderate_video(key, jobId):
     print(response)
 
 
-def hasAnyUnsafeContent(startJobId):
-    maxResults = 10
-    paginationToken = ''
-    finished = False
+def get_confidence_band(confidence):
+    low = min(int(confidence // confidenceBandSize) * confidenceBandSize, 100 - confidenceBandSize)
+    return '%d-%d' % (low, low + confidenceBandSize)
 
-    while finished == False:
-        response = rekognition.get_content_moderation(JobId=startJobId,
-                                                      MaxResults=maxResults,
-                                                      NextToken=paginationToken)
-        if len(response['ModerationLabels']) > 0:
-            return True
 
-        if 'NextToken' in response:
-            paginationToken = response['NextToken']
-        else:
-            finished = True
-    return False
+def summarize_content_moderation(jobId):
+    # Pages through the results at the maximum page size and folds labels into
+    # one entry per (name, confidence band) with the time range they cover.
+    groups = {}
+    blocking = None
+    pages = 0
+    durationMillis = None
+    complete = False
+    request = {'JobId': jobId, 'MaxResults': 1000, 'SortBy': 'TIMESTAMP'}
+    while True:
+        response = rekognition.get_content_moderation(**request)
+        pages += 1
+        durationMillis = response.get('VideoMetadata', {}).get('DurationMillis', durationMillis)
+        for item in response['ModerationLabels']:
+            label = item['ModerationLabel']
+            if label['Confidence'] < minConfidence:
+                continue
+            timestamp = item['Timestamp']
+            band = get_confidence_band(label['Confidence'])
+            group = groups.get((label['Name'], band))
+            if group is None:
+                group = groups[(label['Name'], band)] = {
+                    'name': label['Name'], 'parent': label.get('ParentName', ''),
+                    'confidence': band, 'count': 0, 'start': timestamp, 'end': timestamp,
+                    'maxConfidence': 0}
+            group['count'] += 1
+            group['start'] = min(group['start'], timestamp)
+            group['end'] = max(group['end'], timestamp)
+            group['maxConfidence'] = max(group['maxConfidence'], round(label['Confidence'], 2))
+            if blocking is None and (label['Name'] in blockingLabels or label.get('ParentName') in blockingLabels):
+                blocking = label['Name']
+        complete = 'NextToken' not in response
+        if blocking is not None or complete:
+            break
+        request['NextToken'] = response['NextToken']
+    emit_metrics({'videoModerationPages': pages, 'videoModerationLabels': len(groups)})
+    return {
+        'JobId': jobId,
+        'durationMillis': durationMillis,
+        'blocking': blocking,
+        # False when a blocking label stopped the scan before the last page.
+        'complete': complete,
+        'labels': sorted(groups.values(), key=lambda g: (g['start'], g['name'])),
+    }
 
 
-def lambda_handler(event, context):
-    #print("Received event: " + json.dumps(event, indent=2))
-    message = event['Records'][0]['Sns']['Message']
+def handle_job_result(record, workspace):
+    message = record['Sns']['Message']
     print("From SNS: " + message)
 
     data = json.loads(message)
     jobId = data['JobId']
     key = data['Video']['S3ObjectName']
-    if hasAnyUnsafeContent(jobId):
-        moderate_video(key, jobId)
+    summary = summarize_content_moderation(jobId)
+    if len(summary['labels']) > 0:
+        moderate_video(key, summary)
 
     return message
+
+
+def lambda_handler(event, context):
+    #print("Received event: " + json.dumps(event, indent=2))
+    try:
+        return process_records(event, handle_job_result)
+    finally:
+        emit_limiter_metrics()
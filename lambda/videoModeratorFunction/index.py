@@ -2,19 +2,20 @@ import urllib.parse
 import os
 from common import *
 import boto3
+import uuid
 
 print('Loading function')
 
 
-rekognition = boto3.client('rekognition')
-transcribe = boto3.client('transcribe')
+rekognition = limited_client('rekognition')
+transcribe = limited_client('transcribe')
 
 
-def lambda_handler(event, context):
+def moderate_video(record, context):
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    bucket, key = get_s3_object(record)
+    # Job names must be unique now that one invocation may start several jobs.
+    jobName = '%s-%s' % (context.aws_request_id, uuid.uuid4().hex[:8])
     try:
         response = rekognition.start_content_moderation(
             Video={
@@ -27,7 +28,7 @@ def lambda_handler(event, context):
                 'SNSTopicArn': os.environ['videoContentModerationTopic'],
                 'RoleArn': os.environ['rekognitionServiceRole']
             },
-            JobTag=context.aws_request_id
+            JobTag=jobName
         )
         print(response)
 
@@ -36,7 +37,7 @@ def lambda_handler(event, context):
         safe_filename = output_key.replace('@', "(_!AT!_)")
         safe_filename = safe_filename.replace(' ', "(_!SPACE!_)")
         job_args = {
-            'TranscriptionJobName': context.aws_request_id,
+            'TranscriptionJobName': jobName,
             'Media': {'MediaFileUri':  f's3://{bucket}/{key}'},
             'MediaFormat': file_extension.lower()[1:],
             'LanguageCode': 'en-US',
@@ -51,3 +52,10 @@ def lambda_handler(event, context):
         print(e)
         print('Error getting object {} from bucket {}. Make sure they exist and your bucket is in the same region as this function.'.format(key, bucket))
         raise e
+
+
+def lambda_handler(event, context):
+    try:
+        return process_records(event, lambda record, workspace: moderate_video(record, context))
+    finally:
+        emit_limiter_metrics()
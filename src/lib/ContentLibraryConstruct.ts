@@ -18,6 +18,11 @@ import { VideoConvertorConstruct } from "./VideoConvertorConstruct";
 export interface ContentLibraryConstructProps {
   prefix: string;
   adminEmail?: string;
+  // "object" moderates every extracted file on its own S3 event, "manifest"
+  // moderates the media of a document from one manifest.
+  moderationMode?: string;
+  // Offensive text scoring backend: "remote", "local" or "hybrid".
+  scoringBackend?: string;
 }
 
 export class ContentLibraryConstruct extends Construct {
@@ -26,6 +31,7 @@ export class ContentLibraryConstruct extends Construct {
   public readonly moderationResultTable: Table;
   public readonly moderationFailedTopic: Topic;
   private readonly processingBucket: Bucket;
+  private readonly artifactBucket: Bucket;
   private readonly prefix: string;
   private readonly moderationTopic: Topic;
   private readonly lambdaBuilderConstruct: LambdaBuilderConstruct;
@@ -53,6 +59,15 @@ export class ContentLibraryConstruct extends Construct {
         },
       ],
     });
+    this.artifactBucket = new Bucket(this, "artifactBucket", {
+      removalPolicy: RemovalPolicy.DESTROY,
+      lifecycleRules: [
+        {
+          abortIncompleteMultipartUploadAfter: Duration.days(5),
+          expiration: Duration.days(7),
+        },
+      ],
+    });
 
     this.moderationFailedTopic = new Topic(this, "moderationFailedTopic");
     this.moderationFailedBucket = new Bucket(this, "moderationFailedBucket", {
@@ -78,7 +93,9 @@ export class ContentLibraryConstruct extends Construct {
       this.prefix,
       this.contentLibraryBucket,
       this.processingBucket,
-      this.moderationTopic
+      this.artifactBucket,
+      this.moderationTopic,
+      props.moderationMode ?? "object"
     );
     this.lambdaBuilderConstruct.extractorFunction("msWordExtractorFunction", [
       "docx",
@@ -111,6 +128,7 @@ export class ContentLibraryConstruct extends Construct {
     });
     new TextModeratorConstruct(this, "textModeratorConstruct", {
       lambdaBuilderConstruct: this.lambdaBuilderConstruct,
+      scoringBackend: props.scoringBackend,
     });
     new VideoModeratorConstruct(this, "videoModeratorConstruct", {
       lambdaBuilderConstruct: this.lambdaBuilderConstruct,
@@ -1,6 +1,8 @@
 import {Construct} from "constructs";
 import {LambdaBuilderConstruct} from "./LambdaBuilderConstruct";
 import {Policy, PolicyStatement} from "aws-cdk-lib/aws-iam";
+import {AttributeType, BillingMode, Table} from "aws-cdk-lib/aws-dynamodb";
+import {RemovalPolicy} from "aws-cdk-lib";
 
 export interface ImageModerationConstructProps {
     lambdaBuilderConstruct: LambdaBuilderConstruct;
@@ -18,6 +20,7 @@ export class ImageModeratorConstruct extends Construct {
             "imageModeratorFunction",
             ["jpeg", "jpg", "png"]
         );
+        props.lambdaBuilderConstruct.manifestSource(imageModeratorFunction);
         imageModeratorFunction.role?.attachInlinePolicy(
             new Policy(this, "imageModeratorFunctionPolicy", {
                 statements: [
@@ -31,5 +34,18 @@ export class ImageModeratorConstruct extends Construct {
                 ],
             })
         );
+
+        const imageIndexTable = new Table(this, "imageIndexTable", {
+            partitionKey: {name: "hashKey", type: AttributeType.STRING},
+            sortKey: {name: "sortKey", type: AttributeType.STRING},
+            billingMode: BillingMode.PAY_PER_REQUEST,
+            timeToLiveAttribute: "expiresAt",
+            removalPolicy: RemovalPolicy.DESTROY,
+        });
+        imageIndexTable.grantReadWriteData(imageModeratorFunction);
+        imageModeratorFunction.addEnvironment(
+            "imageIndexTableName",
+            imageIndexTable.tableName
+        );
     }
 }
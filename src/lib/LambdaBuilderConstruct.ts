@@ -12,10 +12,12 @@ import { Construct } from "constructs";
 
 export class LambdaBuilderConstruct extends Construct {
   public readonly processingBucket: Bucket;
+  public readonly artifactBucket: Bucket;
   public readonly moderationTopic: Topic;
   public readonly prefix: string;
   public readonly commonLayer: ILayerVersion;
   public readonly contentLibraryBucket: Bucket;
+  public readonly moderationMode: string;
   private readonly scope: Construct;
 
   constructor(
@@ -24,15 +26,19 @@ export class LambdaBuilderConstruct extends Construct {
     prefix: string,
     contentLibraryBucket: Bucket,
     processingBucket: Bucket,
-    moderationTopic: Topic
+    artifactBucket: Bucket,
+    moderationTopic: Topic,
+    moderationMode: string
   ) {
     super(scope, id);
 
     this.scope = scope;
     this.prefix = prefix;
     this.processingBucket = processingBucket;
+    this.artifactBucket = artifactBucket;
     this.contentLibraryBucket = contentLibraryBucket;
     this.moderationTopic = moderationTopic;
+    this.moderationMode = moderationMode;
 
     this.commonLayer = new PythonLayerVersion(this, "commonLayer", {
       removalPolicy: RemovalPolicy.DESTROY,
@@ -42,12 +48,14 @@ export class LambdaBuilderConstruct extends Construct {
   }
 
   public extractorFunction(functionName: string, extensions: string[]) {
-    return this.getProcessingFunction(
+    const f = this.getProcessingFunction(
       functionName,
       extensions,
       this.processingBucket,
       this.processingBucket
     );
+    this.artifactBucket.grantReadWrite(f);
+    return f;
   }
   public moderatorFunction(
     functionName: string,
@@ -62,10 +70,22 @@ export class LambdaBuilderConstruct extends Construct {
       memorySize
     );
     this.processingBucket.grantReadWrite(f);
+    this.artifactBucket.grantRead(f);
     this.moderationTopic.grantPublish(f);
     return f;
   }
 
+  public manifestSource(processingFunction: PythonFunction) {
+    if (this.moderationMode === "manifest") {
+      processingFunction.addEventSource(
+        new S3EventSource(this.artifactBucket, {
+          events: [EventType.OBJECT_CREATED],
+          filters: [{ suffix: ".manifest" }],
+        })
+      );
+    }
+  }
+
   public getProcessingFunction(
     functionName: string,
     extensions: string[],
@@ -83,6 +103,8 @@ export class LambdaBuilderConstruct extends Construct {
       environment: {
         processingBucket: this.processingBucket.bucketName,
         moderationTopic: this.moderationTopic.topicArn,
+        artifactBucket: this.artifactBucket.bucketName,
+        moderationMode: this.moderationMode,
       },
       timeout: Duration.minutes(5),
       memorySize,
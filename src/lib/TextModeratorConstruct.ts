@@ -7,13 +7,17 @@ import {
   Tracing,
 } from "aws-cdk-lib/aws-lambda";
 import path from "path";
-import { Duration } from "aws-cdk-lib";
+import { Duration, RemovalPolicy } from "aws-cdk-lib";
+import { AttributeType, BillingMode, Table } from "aws-cdk-lib/aws-dynamodb";
 import { S3EventSource } from "aws-cdk-lib/aws-lambda-event-sources";
 import { EventType } from "aws-cdk-lib/aws-s3";
 import { LambdaBuilderConstruct } from "./LambdaBuilderConstruct";
 
 export interface TextModeratorConstructProps {
   lambdaBuilderConstruct: LambdaBuilderConstruct;
+  // "remote" (SageMaker endpoint), "local" (ONNX model in the container) or
+  // "hybrid" (local first, endpoint for uncertain texts).
+  scoringBackend?: string;
 }
 
 export class TextModeratorConstruct extends Construct {
@@ -24,15 +28,25 @@ export class TextModeratorConstruct extends Construct {
   ) {
     super(scope, id);
     const lambdaBuilderConstruct = props.lambdaBuilderConstruct;
+    const hfModelId = "cardiffnlp/twitter-roberta-base-offensive";
+    const maxConcurrency = 5;
+    const scoringBackend = props.scoringBackend ?? "remote";
     const huggingFaceSagemakerServerlessInferenceConstruct =
       new HuggingFaceSagemakerServerlessInferenceConstruct(
         this,
         "huggingFaceSagemakerServerlessInferenceConstruct",
         {
-          hfModelId: "cardiffnlp/twitter-roberta-base-offensive",
+          hfModelId,
           hfTask: "text-classification",
+          maxConcurrency,
         }
       );
+    const scoreCacheTable = new Table(this, "scoreCacheTable", {
+      partitionKey: { name: "key", type: AttributeType.STRING },
+      billingMode: BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: "expiresAt",
+      removalPolicy: RemovalPolicy.DESTROY,
+    });
     const textModeratorFunction = new DockerImageFunction(
       this,
       "textModeratorFunction",
@@ -42,6 +56,10 @@ export class TextModeratorConstruct extends Construct {
           path.join(__dirname, "..", "..", "lambda", "textModeratorFunction"),
           {
             cmd: ["index.lambda_handler"],
+            buildArgs: {
+              SCORING_BACKEND: scoringBackend,
+              HF_MODEL_ID: hfModelId,
+            },
           }
         ),
         memorySize: 2048,
@@ -51,6 +69,10 @@ export class TextModeratorConstruct extends Construct {
           moderationTopic: lambdaBuilderConstruct.moderationTopic.topicArn,
           huggingFaceModelEndpointName:
             huggingFaceSagemakerServerlessInferenceConstruct.endpointName,
+          huggingFaceModelId: hfModelId,
+          scoreCacheTableName: scoreCacheTable.tableName,
+          sagemakerMaxConcurrency: "" + maxConcurrency,
+          scoringBackend,
         },
         tracing: Tracing.ACTIVE,
       }
@@ -70,6 +92,7 @@ export class TextModeratorConstruct extends Construct {
       )
     );
     lambdaBuilderConstruct.moderationTopic.grantPublish(textModeratorFunction);
+    scoreCacheTable.grantReadWriteData(textModeratorFunction);
     textModeratorFunction.role?.attachInlinePolicy(
       new Policy(this, "offensiveTextModeratorFunctionPolicy", {
         statements: [
@@ -16,6 +16,8 @@ export class AwsAiContentLibraryStack extends Stack {
       {
         prefix: "dev",
         adminEmail: process.env.adminEmail,
+        moderationMode: process.env.moderationMode,
+        scoringBackend: process.env.scoringBackend,
       }
     );
 
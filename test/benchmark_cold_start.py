@@ -0,0 +1,68 @@
+"""Measure text moderator import time and first-invocation latency.
+
+Every run starts a fresh interpreter, so module caches do not carry over.
+Run from the repository root with the text moderator dependencies installed:
+
+    python test/benchmark_cold_start.py --runs 5
+
+Scoring stays local: the cascade bands are set so that no text is sent to
+the SageMaker endpoint.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+FUNCTION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "..", "lambda", "textModeratorFunction")
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+import index
+imported = time.perf_counter()
+from scoring import score_texts
+texts = ["thanks everyone for joining the quarterly review"] * 32
+score_texts(texts)
+first = time.perf_counter()
+score_texts([t + " again" for t in texts])
+second = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "firstCall": first - imported,
+    "warmCall": second - first,
+}))
+"""
+
+
+def run_once(preload):
+    env = dict(os.environ,
+               AWS_DEFAULT_REGION=os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'),
+               huggingFaceModelEndpointName='unused',
+               cascadeLowerBand='2',
+               preloadModels='true' if preload else 'false')
+    env.pop('scoreCacheTableName', None)
+    output = subprocess.run([sys.executable, "-c", PROBE], cwd=FUNCTION_DIR, env=env,
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print("%-10s %10s %10s %10s" % ("preload", "import", "firstCall", "warmCall"))
+    for preload in (False, True):
+        runs = [run_once(preload) for _ in range(args.runs)]
+        print("%-10s %9.3fs %9.3fs %9.3fs" % (
+            preload,
+            statistics.median(r["import"] for r in runs),
+            statistics.median(r["firstCall"] for r in runs),
+            statistics.median(r["warmCall"] for r in runs)))
+
+
+if __name__ == '__main__':
+    main()
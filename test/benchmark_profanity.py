@@ -0,0 +1,65 @@
+"""Compare per-line and vectorized profanity scoring on a synthetic transcript.
+
+Run from the repository root with the text moderator dependencies installed:
+
+    python test/benchmark_profanity.py --lines 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "textModeratorFunction"))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from profanity_check import predict_prob  # noqa: E402
+from scoring import predict_profanity_scores  # noqa: E402
+
+WORDS = ("the meeting will start with a short review of last quarter and then "
+         "we move on to the product roadmap please keep questions until the end "
+         "thanks everyone for joining today damn this slide is hard to read").split()
+
+
+def make_transcript(lines, seed=42):
+    rng = random.Random(seed)
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 25)))
+            for _ in range(lines)]
+
+
+def per_line(lines):
+    return [predict_prob([line])[0] for line in lines]
+
+
+def vectorized(lines):
+    # Uncached, so every repeat does the full scoring work.
+    return predict_profanity_scores(lines)
+
+
+def measure(fn, lines, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(lines)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = make_transcript(args.lines)
+    perLine = measure(per_line, lines, args.repeat)
+    vector = measure(vectorized, lines, args.repeat)
+    print("lines:      %d" % len(lines))
+    print("per-line:   %.3fs" % perLine)
+    print("vectorized: %.3fs" % vector)
+    print("speedup:    %.1fx" % (perLine / vector))
+
+
+if __name__ == '__main__':
+    main()
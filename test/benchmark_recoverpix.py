@@ -0,0 +1,103 @@
+"""Compare PDF image encoding modes on a synthetic image-heavy PDF.
+
+Run from the repository root with pymupdf and Pillow installed:
+
+    python test/benchmark_recoverpix.py --pages 50
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "pdfExtractorFunction"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "commonLayer"))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import fitz  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+from index import recoverpix  # noqa: E402
+
+MODES = ["legacy", "native", "jpeg", "png", "auto"]
+
+
+def make_photo(rng, size):
+    # Gradient with noise, compresses like a scanned photograph.
+    noise = Image.effect_noise(size, rng.randint(20, 60))
+    gradient = Image.linear_gradient("L").resize(size)
+    return Image.merge("RGB", (noise, gradient, Image.eval(noise, lambda v: 255 - v)))
+
+
+def make_graphic(rng, size):
+    # Flat colours and text, like a chart or screenshot.
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        colour = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle([x, y, x + rng.randint(20, 200), y + rng.randint(20, 200)], fill=colour)
+    draw.text((10, 10), "Quarterly results", fill="black")
+    return image
+
+
+def encode(image, fmt, **kwargs):
+    output = io.BytesIO()
+    image.save(output, format=fmt, **kwargs)
+    return output.getvalue()
+
+
+def make_pdf(pages, seed=42):
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for _ in range(pages):
+        page = doc.new_page()
+        size = (rng.randint(600, 1600), rng.randint(600, 1200))
+        photo = make_photo(rng, size)
+        streams = [
+            encode(photo, "JPEG", quality=90),
+            encode(photo.convert("CMYK"), "JPEG", quality=90),
+            encode(make_graphic(rng, size), "PNG"),
+            encode(make_graphic(rng, size).convert("RGBA"), "PNG"),
+        ]
+        transparent = photo.convert("RGBA")
+        transparent.putalpha(Image.linear_gradient("L").resize(size))
+        streams.append(encode(transparent, "PNG"))
+        for i, stream in enumerate(streams):
+            rect = fitz.Rect(20 + (i % 3) * 190, 20 + (i // 3) * 260, 200 + (i % 3) * 190, 260 + (i // 3) * 260)
+            page.insert_image(rect, stream=stream)
+    return fitz.open("pdf", doc.tobytes())
+
+
+def measure(doc, mode):
+    start = time.perf_counter()
+    total = 0
+    seen = set()
+    for pno in range(doc.page_count):
+        for img in doc.get_page_images(pno):
+            if img[0] in seen:
+                continue
+            seen.add(img[0])
+            total += len(recoverpix(doc, img, mode)["image"])
+    return time.perf_counter() - start, len(seen), total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--modes', default=",".join(MODES))
+    args = parser.parse_args()
+
+    doc = make_pdf(args.pages)
+    baseline = None
+    print("%-8s %10s %8s %12s %8s" % ("mode", "seconds", "images", "bytes", "speedup"))
+    for mode in args.modes.split(","):
+        seconds, images, total = measure(doc, mode)
+        baseline = baseline or seconds
+        print("%-8s %10.3f %8d %12d %7.1fx" % (mode, seconds, images, total, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Offline check of the local ONNX scoring backend against a tiny model.
+
+Builds a small random classifier with a word-level tokenizer, then checks
+that OnnxClassifier keeps the endpoint score contract and the input order
+across dynamic batches. Needs numpy, onnx, onnxruntime and tokenizers:
+
+    python test/onnx_backend_smoke.py
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "textModeratorFunction"))
+
+import numpy as np  # noqa: E402
+from export_onnx_model import build_tiny_model  # noqa: E402
+from onnx_classifier import OnnxClassifier  # noqa: E402
+
+TEXTS = [
+    "the meeting starts now",
+    "you stupid idiot",
+    "",
+    "thanks everyone please review the slides " * 20,
+    "damn",
+    "unknown words only",
+]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as modelDir:
+        build_tiny_model(modelDir)
+        # A small token budget forces several batches.
+        model = OnnxClassifier(modelDir, maxBatchTokens=16)
+        scores = model.predict(TEXTS)
+
+        assert scores.shape == (len(TEXTS),), scores.shape
+        assert np.all((scores == 0) | ((scores >= 0.5) & (scores <= 1))), scores
+        one_by_one = np.concatenate([model.predict([text]) for text in TEXTS])
+        assert np.allclose(scores, one_by_one), (scores, one_by_one)
+        assert scores[1] > 0.5 and scores[4] > 0.5, scores
+        assert scores[0] == 0 and scores[3] == 0, scores
+        assert model.predict([]).shape == (0,)
+    for text, score in zip(TEXTS, scores):
+        print("%.3f  %s" % (score, text[:40]))
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
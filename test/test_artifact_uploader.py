@@ -0,0 +1,87 @@
+"""ArtifactUploader and manifest checks against a mocked S3.
+
+Run from the repository root with boto3, moto and pytest installed:
+
+    python -m pytest test/test_artifact_uploader.py
+"""
+import json
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "commonLayer"))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import common  # noqa: E402
+
+BUCKET = 'processing-bucket'
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def test_uploads_bytes_and_files(s3, tmp_path):
+    path = tmp_path / 'page1.png'
+    path.write_bytes(b'png' * 100)
+    with common.ArtifactUploader(BUCKET, max_workers=2, s3_client=s3) as uploader:
+        uploader.put_bytes('doc/pdf/page0.jpg', b'jpeg' * 10)
+        uploader.put_file(path, 'doc/pdf/page1.png')
+    manifest = sorted(uploader.manifest, key=lambda r: r['key'])
+    assert [(r['key'], r['size'], r['status']) for r in manifest] == [
+        ('doc/pdf/page0.jpg', 40, 'OK'),
+        ('doc/pdf/page1.png', 300, 'OK'),
+    ]
+    assert manifest[0]['file'] is None
+    assert manifest[1]['file'] == str(path)
+    # Uploaded files are removed from the workspace.
+    assert not path.exists()
+    body = s3.get_object(Bucket=BUCKET, Key='doc/pdf/page1.png')['Body'].read()
+    assert body == b'png' * 100
+
+
+def test_failed_upload_keeps_file_and_raises(s3, tmp_path):
+    path = tmp_path / 'page1.png'
+    path.write_bytes(b'png')
+    with pytest.raises(Exception, match='1 of 2 uploads failed'):
+        with common.ArtifactUploader(BUCKET, max_workers=2, s3_client=s3) as uploader:
+            uploader.put_bytes('doc/pdf/page0.jpg', b'jpeg')
+            uploader.put_file(path, 'doc/pdf/page1.png', bucket='missing-bucket')
+    failed = [r for r in uploader.manifest if r['status'] != 'OK']
+    assert [r['key'] for r in failed] == ['doc/pdf/page1.png']
+    assert failed[0]['bucket'] == 'missing-bucket'
+    assert failed[0]['error']
+    assert path.exists()
+
+
+def test_close_does_not_check_uploads(s3):
+    uploader = common.ArtifactUploader('missing-bucket', max_workers=1, s3_client=s3)
+    uploader.put_bytes('doc/pdf/page0.jpg', b'jpeg')
+    manifest = uploader.close()
+    assert [r['status'] for r in manifest] == ['FAILED']
+    with pytest.raises(Exception, match='1 of 1 uploads failed'):
+        common.check_uploads(manifest)
+
+
+def test_write_manifest_lists_uploaded_artifacts(s3, monkeypatch):
+    monkeypatch.setattr(common, 'mediaBucket', BUCKET)
+    monkeypatch.setattr(common, 's3', s3)
+    uploads = [
+        common.upload_bytes(b'a' * 5, BUCKET, 'doc/pdf/page0.jpg', s3),
+        common.upload_bytes(b'b', 'missing-bucket', 'doc/pdf/page1.jpg', s3),
+    ]
+    manifestKey = common.write_manifest('doc.pdf', uploads)
+    assert manifestKey == 'doc/pdf/' + common.manifestName
+    manifest = json.loads(s3.get_object(Bucket=BUCKET, Key=manifestKey)['Body'].read())
+    assert manifest == {
+        'source': 'doc.pdf',
+        'artifacts': [{'bucket': BUCKET, 'key': 'doc/pdf/page0.jpg', 'size': 5}],
+    }
@@ -0,0 +1,143 @@
+"""Window, scan and transcript segment checks for the text moderator.
+
+Run from the repository root with pytest installed:
+
+    python -m pytest test/test_chunking.py
+"""
+import io
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "textModeratorFunction"))
+
+from chunking import (get_word_cost, iter_json_array, iter_transcript_segments,  # noqa: E402
+                      iter_windows, scan, tokenPattern)
+
+
+def tokens(text):
+    return [m.group() for m in tokenPattern.finditer(text)]
+
+
+def window_costs(text, windows):
+    return [sum(get_word_cost(w) for w in tokens(text[start:end])) for start, end in windows]
+
+
+def test_word_cost():
+    assert get_word_cost('meeting') == 1
+    assert get_word_cost('会') == 2
+    assert get_word_cost('a' * 12) == 1
+    assert get_word_cost('a' * 13) == 4
+    assert get_word_cost('a' * 32) == 8
+
+
+def test_long_runs_are_cut_at_32_characters():
+    assert [len(t) for t in tokens('x' * 100)] == [32, 32, 32, 4]
+    assert tokens('ab会議cd') == ['ab', '会', '議', 'cd']
+
+
+def test_english_windows_overlap():
+    words = ['w%d' % i for i in range(400)]
+    text = ' '.join(words)
+    windows = list(iter_windows(text, size=160, overlap=32))
+    chunks = [text[start:end].split() for start, end in windows]
+    assert [len(c) for c in chunks] == [160, 160, 144]
+    assert chunks[0][-32:] == chunks[1][:32]
+    assert chunks[1][-32:] == chunks[2][:32]
+    assert chunks[-1][-1] == words[-1]
+
+
+def test_cjk_windows_stay_within_budget():
+    text = '会' * 200
+    windows = list(iter_windows(text, size=160, overlap=32))
+    assert [end - start for start, end in windows] == [80, 80, 72]
+    assert max(window_costs(text, windows)) <= 160
+    assert windows[-1][1] == len(text)
+
+
+def test_dense_runs_stay_within_budget():
+    text = 'QUJD' * 400
+    windows = list(iter_windows(text, size=160, overlap=32))
+    assert max(window_costs(text, windows)) <= 160
+    assert windows[0] == (0, 640)
+    assert windows[-1][1] == len(text)
+
+
+def test_short_text_is_one_window():
+    assert list(iter_windows('hello there', size=160, overlap=32)) == [(0, 11)]
+    assert list(iter_windows('   ', size=160, overlap=32)) == []
+
+
+def fake_scores(texts):
+    # Each window scores the number of 'bad' words it holds.
+    return {'Offensive': [t.split().count('bad') / 10 for t in texts],
+            'Profanity': [0.0 for _ in texts]}
+
+
+def test_scan_keeps_the_best_window_per_source():
+    text = ' '.join(['ok'] * 300 + ['bad', 'bad'] + ['ok'] * 10)
+    (source, best), = scan([('page1', text)], fake_scores)
+    window = best['Offensive']
+    assert source == 'page1'
+    assert window['score'] == 0.2
+    assert text[window['start']:window['end']] == window['text']
+    assert window['text'].split().count('bad') == 2
+    assert best['Profanity']['score'] == 0.0
+
+
+def test_scan_yields_sources_in_order_as_they_complete():
+    batches = []
+    yielded = []
+
+    def score_fn(texts):
+        batches.append(len(texts))
+        return fake_scores(texts)
+
+    units = [('a', 'bad ' * 3), ('b', ''), ('c', 'ok ' * 300), ('d', 'bad')]
+    for source, best in scan(units, score_fn, batchSize=2):
+        # A source is reported once a batch holding a later source is scored.
+        yielded.append((source, len(batches)))
+    assert yielded == [('a', 1), ('c', 3), ('d', 3)]
+    assert batches == [2, 2, 1]
+
+
+def test_scan_flushes_a_partial_batch():
+    results = list(scan([('a', 'bad ok'), ('b', 'ok')], fake_scores, batchSize=100))
+    assert [(source, best['Offensive']['score']) for source, best in results] == [
+        ('a', 0.1), ('b', 0.0)]
+
+
+def word(content, start, end):
+    return {'type': 'pronunciation', 'start_time': str(start), 'end_time': str(end),
+            'alternatives': [{'content': content}]}
+
+
+def punctuation(content):
+    return {'type': 'punctuation', 'alternatives': [{'content': content}]}
+
+
+def test_transcript_segments_follow_sentences():
+    items = [word('Hello', 0.5, 0.9), word('there', 1.0, 1.4), punctuation('.'),
+             word('Next', 2.0, 2.3), punctuation(','), word('one', 2.4, 2.8)]
+    assert list(iter_transcript_segments(items)) == [
+        ((0, 0.5, 1.4), 'Hello there.'),
+        ((1, 2.0, 2.8), 'Next, one'),
+    ]
+
+
+def test_transcript_segments_are_cut_by_time_and_words():
+    items = [word('w%d' % i, i, i + 0.5) for i in range(10)]
+    segments = list(iter_transcript_segments(items, maxSeconds=4, maxWords=100))
+    assert [key for key, _ in segments] == [(0, 0, 3.5), (1, 4, 7.5), (2, 8, 9.5)]
+    segments = list(iter_transcript_segments(items, maxSeconds=100, maxWords=3))
+    assert [text for _, text in segments] == ['w0 w1 w2', 'w3 w4 w5', 'w6 w7 w8', 'w9']
+
+
+def test_transcript_items_are_streamed_from_the_file():
+    items = [word('w%d' % i, i, i + 0.5) for i in range(1000)]
+    content = {'jobName': 'job', 'results': {
+        'transcripts': [{'transcript': 'he said "items": ['}], 'items': items}}
+    text = json.dumps(content, indent=2)
+    assert list(iter_json_array(io.StringIO(text), readSize=7)) == items
+    assert list(iter_json_array(io.StringIO(json.dumps({'page1': 'text'})))) == []
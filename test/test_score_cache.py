@@ -0,0 +1,167 @@
+"""Score cache tier checks; no AWS access is needed.
+
+Run from the repository root with boto3, numpy and pytest installed:
+
+    python -m pytest test/test_score_cache.py
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "textModeratorFunction"))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import score_cache  # noqa: E402
+from score_cache import DynamoDbTier, InMemoryTier, LruTier, ScoreCache, get_cache_key  # noqa: E402
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(score_cache.time, 'time', clock.time)
+    return clock
+
+
+def test_lru_tier_expires_entries(clock):
+    tier = LruTier(maxSize=10, ttl=60)
+    tier.put_many({'a': 0.1})
+    clock.now += 59
+    assert tier.get_many(['a']) == {'a': 0.1}
+    clock.now += 1
+    assert tier.get_many(['a']) == {}
+    assert 'a' not in tier.items
+    assert tier.stats() == {'lruCacheHits': 1, 'lruCacheMisses': 1}
+
+
+def test_lru_tier_evicts_least_recently_used():
+    tier = LruTier(maxSize=2)
+    tier.put_many({'a': 0.1, 'b': 0.2})
+    tier.get_many(['a'])
+    tier.put_many({'c': 0.3})
+    assert tier.get_many(['a', 'b', 'c']) == {'a': 0.1, 'c': 0.3}
+
+
+def test_in_memory_tier_is_unbounded(clock):
+    tier = InMemoryTier(ttl=10)
+    tier.put_many({str(i): float(i) for i in range(20000)})
+    assert len(tier.get_many([str(i) for i in range(20000)])) == 20000
+    clock.now += 10
+    assert tier.get_many(['0']) == {}
+    assert tier.stats(reset=True) == {'sharedCacheHits': 20000, 'sharedCacheMisses': 1}
+    assert tier.stats() == {'sharedCacheHits': 0, 'sharedCacheMisses': 0}
+
+
+class FakeDynamoDb:
+    # Leaves the last key of every batch_get_item unprocessed `stalls` times.
+    def __init__(self, stalls):
+        self.stalls = stalls
+        self.items = {}
+        self.getRequests = []
+
+    def batch_get_item(self, RequestItems):
+        (table, request), = RequestItems.items()
+        self.getRequests.append([k['key']['S'] for k in request['Keys']])
+        keys = request['Keys']
+        unprocessed = {}
+        if self.stalls > 0:
+            self.stalls -= 1
+            unprocessed = {table: dict(request, Keys=keys[-1:])}
+            keys = keys[:-1]
+        found = [self.items[k['key']['S']] for k in keys if k['key']['S'] in self.items]
+        return {'Responses': {table: found}, 'UnprocessedKeys': unprocessed}
+
+    def batch_write_item(self, RequestItems):
+        (table, requests), = RequestItems.items()
+        for request in requests:
+            item = request['PutRequest']['Item']
+            self.items[item['key']['S']] = item
+        return {'UnprocessedItems': {}}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(score_cache.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_dynamodb_tier_retries_unprocessed_keys(sleeps):
+    client = FakeDynamoDb(stalls=2)
+    tier = DynamoDbTier('scores', client=client, backoffBase=0.1)
+    tier.put_many({'a': 0.1, 'b': 0.2})
+    assert tier.get_many(['a', 'b', 'a']) == {'a': 0.1, 'b': 0.2}
+    assert client.getRequests == [['a', 'b'], ['b'], ['b']]
+    # Full jitter stays under base * 2 ** attempt.
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.1 and 0 <= sleeps[1] <= 0.2
+
+
+def test_dynamodb_tier_gives_up_after_max_attempts(sleeps):
+    client = FakeDynamoDb(stalls=10)
+    tier = DynamoDbTier('scores', client=client, maxAttempts=3)
+    tier.put_many({'a': 0.1})
+    assert tier.get_many(['a']) == {}
+    assert len(client.getRequests) == 3
+    assert len(sleeps) == 2
+    assert tier.stats() == {'sharedCacheHits': 0, 'sharedCacheMisses': 1}
+
+
+def test_score_cache_scores_each_text_once():
+    calls = []
+
+    def score_fn(texts):
+        calls.append(texts)
+        return [len(text) / 10 for text in texts]
+
+    cache = ScoreCache(LruTier(), InMemoryTier())
+    # Texts that only differ in whitespace share a key.
+    scores = cache.get_scores('m', ['ab', 'ab ', 'abc', 'a  b', 'a b'], score_fn)
+    assert list(scores) == [0.2, 0.2, 0.3, 0.4, 0.4]
+    assert calls == [['ab', 'abc', 'a  b']]
+    assert get_cache_key('m', 'a  b') == get_cache_key('m', 'a b')
+
+
+def test_score_cache_counts_tier_hits_and_misses():
+    shared = InMemoryTier()
+    first = ScoreCache(LruTier(), shared)
+    first.get_scores('m', ['a', 'b'], lambda texts: [0.5] * len(texts))
+    # A second container starts with an empty local tier.
+    second = ScoreCache(LruTier(), shared)
+    calls = []
+
+    def score_fn(texts):
+        calls.append(texts)
+        return [0.9] * len(texts)
+
+    assert list(second.get_scores('m', ['a', 'c'], score_fn)) == [0.5, 0.9]
+    assert list(second.get_scores('m', ['a', 'c'], score_fn)) == [0.5, 0.9]
+    assert calls == [['c']]
+    assert second.stats(reset=True) == {
+        'lruCacheHits': 2, 'lruCacheMisses': 2,
+        'sharedCacheHits': 1, 'sharedCacheMisses': 3, 'sharedCacheErrors': 0,
+    }
+
+
+def test_score_cache_treats_shared_errors_as_misses():
+    class FailingTier(InMemoryTier):
+        def get_many(self, keys):
+            raise RuntimeError('throttled')
+
+        def put_many(self, scores):
+            raise RuntimeError('throttled')
+
+    cache = ScoreCache(LruTier(), FailingTier())
+    assert list(cache.get_scores('m', ['a'], lambda texts: [0.4])) == [0.4]
+    assert cache.stats()['sharedCacheErrors'] == 2
+    # The local tier still serves the score.
+    assert list(cache.get_scores('m', ['a'], lambda texts: [1.0])) == [0.4]